@@ -4,7 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from progress import Node
-from imageProcess import ceilBy, StreamState, identity, initModel, trans, transInv, doCrop, prepareOpt
+from imageProcess import ceilBy, StreamState, identity, initModel, trans, transInv, doCrop, prepareOpt, getGrid, warp
 from runSlomo import newOpt, getOptS, getOptP, makeStreamFunc
 from config import config
 
@@ -21,18 +21,16 @@ class Warp(nn.Module):
     super(Warp, self).__init__()
     self.padding_mode = padding_mode
 
-  def setSize(self, H, W):
-    kwarg = {'indexing': 'ij'} if torch.__version__ >= '1.10' else {}
-    gridY, gridX = torch.meshgrid(torch.linspace(-1.0, 1.0, H), torch.linspace(-1.0, 1.0, W), **kwarg)
-    self.kh = 2.0 / (H - 1)
-    self.kw = 2.0 / (W - 1)
-    self.register_buffer('grid', torch.cat((gridX, gridY), 0).view(1, 2, H, W))
-    return self
-
   def forward(self, img, flow):
-    flow_ = torch.stack([flow[:, 0, :, :] * self.kw, flow[:, 1, :, :] * self.kh], 1)
-    grid = (self.grid + flow_).permute(0, 2, 3, 1)
-    return F.grid_sample(img, grid, padding_mode=self.padding_mode, mode='bilinear', align_corners=True)
+    return warp(img, flow, 1, self.padding_mode)
+
+  def shared(self, img, flows):
+    """Warp one image (1, c, h, w) by the flows (t, 2, h, w) of t timesteps in a single sampling pass."""
+    t, _, h, w = flows.shape
+    grid, k = getGrid(h, w, flows.dtype, flows.device, 1)
+    grid = torch.addcmul(grid, flows.permute(0, 2, 3, 1), k).view(1, t * h, w, 2)
+    out = F.grid_sample(img, grid, padding_mode=self.padding_mode, mode='bilinear', align_corners=True)
+    return out.view(-1, t, h, w).transpose(0, 1)
 
 resize = lambda x: F.interpolate(x, scale_factor=2, mode="bilinear", align_corners=False)
 
@@ -106,6 +104,9 @@ class IFRNetDecoder(nn.Module):
     self.ensemble = ensemble
     self.ramCoef = ramCoef
     self.flows = []
+    self.shareTime = False
+    self.motionThreshold = 0
+    self.outChannels = 4 + chsOut[-1]
     self.chsIn = chsIn
     self.chsAdd = chsAdd
     self.chsSide = side_channels
@@ -114,7 +115,7 @@ class IFRNetDecoder(nn.Module):
 
   def setSize(self, h, w, x):
     for i in range(4):
-      self.warps[i].setSize(h >> (3 - i), w >> (3 - i)).to(x)
+      getGrid(h >> (3 - i), w >> (3 - i), x.dtype, x.device, 1)
     if self.ensemble:
       for i, d, cIn, cAdd in zip(range(4), self.decoders, self.chsIn, self.chsAdd):
         sd = d.state_dict()
@@ -128,20 +129,14 @@ class IFRNetDecoder(nn.Module):
         self.flows.append(opt)
     return self
 
-  def forward(self, x, embt, **_):
-    embt = [t[0] for t in embt]
-    ids = sum(([i] * len(t) for i, t in enumerate(embt)), [])
-    *_, c, h, w = x[0].shape
-    args = (x[0][ids].view(-1, 2 * c, h, w), torch.cat(embt).view(-1, 1, 1, 1).repeat(1, 1, h, w))
+  def decodeBatch(self, x0, warpFeatures):
+    args = (x0,)
     for i in range(4):
       if i:
         up_flow0, up_flow1, ft_ = args
-        ft = x[i][ids]
-        warp = self.warps[i - 1]
-        f0_warp = warp(ft[:, 0], up_flow0)
-        f1_warp = warp(ft[:, 1], up_flow1)
+        f0_warp, f1_warp = warpFeatures(i, up_flow0, up_flow1)
         args = (ft_, f0_warp, f1_warp, up_flow0, up_flow1)
-      xF = torch.cat(args, 1)
+      xF = torch.cat(args, 1) if i else x0
       out = doCrop(self.decode[i], xF)
       if self.ensemble:
         opt0, opt1 = self.flows[i], self.flows[i].transposedOpt
@@ -155,6 +150,84 @@ class IFRNetDecoder(nn.Module):
         up_flow1_ += 2.0 * resize(up_flow1)
       if i == 3: break
       args = (up_flow0_, up_flow1_, ft_)
+    return out
+
+  def decodeShared(self, x, chunk):
+    """Decode timesteps of [(pair index, embeddings)] without gathering features per timestep."""
+    lens = [len(e) for _, e in chunk]
+    *_, c, h, w = x[0].shape
+    x0 = x[0].new_empty((sum(lens), 2 * c + 1, h, w))
+    k = 0
+    for (p, e), l in zip(chunk, lens):
+      x0[k:k + l, :2 * c] = x[0][p].view(1, 2 * c, h, w) # broadcast to all timesteps of the pair
+      x0[k:k + l, 2 * c:] = e.view(-1, 1, 1, 1)
+      k += l
+    def warpFeatures(i, *flows):
+      warp = self.warps[i - 1]
+      res = []
+      for j, flow in enumerate(flows):
+        k, r = 0, []
+        for (p, _), l in zip(chunk, lens):
+          r.append(warp.shared(x[i][p, j:j + 1], flow[k:k + l]))
+          k += l
+        res.append(torch.cat(r) if len(r) > 1 else r[0])
+      return res
+    return self.decodeBatch(x0, warpFeatures)
+
+  def forwardShared(self, x, embt):
+    *_, h, w = x[3].shape
+    # timesteps per batch, so that the finest level still fits without tiling
+    n = max(1, int(config.calcFreeMem() * self.ramCoef / (h * w)))
+    segments = [(p, e[k:k + n]) for p, e in enumerate(embt) for k in range(0, len(e), n)]
+    outs, chunk, count = [], [], 0
+    for p, e in segments:
+      if count + len(e) > n:
+        outs.append(self.decodeShared(x, chunk))
+        chunk, count = [], 0
+      chunk.append((p, e))
+      count += len(e)
+    outs.append(self.decodeShared(x, chunk))
+    return torch.cat(outs) if len(outs) > 1 else outs[0]
+
+  def estimateMotion(self, x):
+    """Largest flow magnitude of each frame pair in full resolution pixels, estimated by the coarsest level."""
+    *_, c, h, w = x[0].shape
+    n = len(x[0])
+    x0 = torch.cat((x[0].view(n, 2 * c, h, w), x[0].new_full((n, 1, h, w), .5)), 1)
+    out = doCrop(self.decode[0], x0)
+    flow = out[:, :4].view(n, 2, 2, *out.shape[-2:]) # level 0 outputs in 1/8 resolution
+    return flow.norm(dim=2).flatten(1).amax(1) * 8
+
+  def blendOut(self, x, e):
+    """Decoded output of a static pair, zero flows and residual, mask linearly blends the 2 frames."""
+    *_, h, w = x[3].shape
+    out = x[3].new_zeros((len(e), self.outChannels, h << 1, w << 1))
+    out[:, 4] = torch.logit(1 - e, 1e-6).view(-1, 1, 1)
+    return out
+
+  def forward(self, x, embt, **_):
+    embt = [t[0] for t in embt]
+    if self.motionThreshold and len(embt):
+      static = (self.estimateMotion(x) < self.motionThreshold).tolist()
+      if any(static):
+        dynamic = [i for i, b in enumerate(static) if not b]
+        res = self.decodePairs([t[dynamic] for t in x], [embt[i] for i in dynamic]) if dynamic else []
+        res.reverse()
+        return [self.blendOut(x, e) if b else res.pop() for b, e in zip(static, embt)]
+    return self.decodePairs(x, embt)
+
+  def decodePairs(self, x, embt):
+    if self.shareTime and sum(len(t) for t in embt):
+      out = self.forwardShared(x, embt)
+    else:
+      ids = sum(([i] * len(t) for i, t in enumerate(embt)), [])
+      *_, c, h, w = x[0].shape
+      x0 = torch.cat((x[0][ids].view(-1, 2 * c, h, w), torch.cat(embt).view(-1, 1, 1, 1).repeat(1, 1, h, w)), 1)
+      def warpFeatures(i, up_flow0, up_flow1):
+        ft = x[i][ids]
+        warp = self.warps[i - 1]
+        return warp(ft[:, 0], up_flow0), warp(ft[:, 1], up_flow1)
+      out = self.decodeBatch(x0, warpFeatures)
     # break `out` into Tuple[Tensor] to keep pairing with input data
     return list(out.split([len(t) for t in embt]))
 
@@ -296,6 +369,9 @@ def getOpt(option):
   modules['decoder']['ramCoef'] = decoderRamCoef[model]
   opt = getOptP(getOptS(modelPaths[model], modules, {}))
   opt.sf = option['sf']
+  opt.decoder.shareTime = opt.sf >= 8 # many timesteps per frame pair
+  # pairs moving less than this many pixels are linearly blended instead of decoded
+  opt.decoder.motionThreshold = option.get('motion', 1.) if option.get('adaptive', False) else 0
   opt.dedupe = option.get('dedupe', False)
   opt.dedupeLow = option.get('low', .5)
   opt.dedupeHigh = option.get('high', .993)
@@ -2,30 +2,28 @@ import sys
 import multiprocessing as mp
 sys.path.append('./python')
 sys.path.append('./pyc')
-from defaultConfig import defaultConfig
-sharedMemSize = defaultConfig['sharedMemSize'][0]
+from userConfig import setConfig
+startConfig = {}
+try:
+  setConfig(startConfig)
+except Exception:
+  from defaultConfig import defaultConfig
+  startConfig = {key: defaultConfig[key][0] for key in defaultConfig}
 isWindows = sys.platform[:3] == 'win'
-mmName = 'SharedMemoryMoe'
-
-def getMM(size, create=True):
-  if isWindows:
-    from mmap import mmap
-    return mmap(-1, size, tagname=mmName)
-  else: # requires Python >= 3.8
-    from multiprocessing.shared_memory import SharedMemory
-    shm = SharedMemory(mmName, create, size)
-    return shm
 
 if isWindows:
   from subprocess import Popen
   Popen(['chcp', '65001'], shell=True).wait()
 
-def main():
+def main(index=0, device=None):
+  from config import config
+  if device is not None: # before imageProcess takes the default device
+    config.setDevice(device)
   from progress import Node
-  from worker import begin, context, enhance
-  from procedure import genProcess
+  from worker import begin, context, enhance, flush
+  from procedure import genProcess, processBatch
   from video import SR_vid
-  from config import config
+  from profiling import profiled
   stepFile = [{'op': 'file'}]
   imNode = Node({'op': 'image'}, learn=0)
 
@@ -41,37 +39,49 @@ def main():
       node.trace()
     return duration
 
-  def imageEnhance(size, *args):
+  def imageEnhance(slot, *args):
     outputOpt = args[-1]
     name = outputOpt['file'] if 'file' in outputOpt else None
     if not ('op' in outputOpt and outputOpt['op'] == 'output'):
       outputOpt = {}
-    bench = outputOpt.get('diagnose', {}).get('bench', False)
+    diagnose = outputOpt.get('diagnose', {})
+    bench = diagnose.get('bench', False)
     trace = outputOpt.get('trace', False) or bench
     process, nodes = genProcess(stepFile + list(args))
-    return begin(imNode, nodes, trace, bench).bindFunc(process)(size, name=name)
+    return profiled(begin(imNode, nodes, trace, bench).bindFunc(process), diagnose, 'image')(slot, name=name)
+
+  def videoEnhance(video, by, *steps):
+    return profiled(SR_vid, steps[-1].get('diagnose', {}), 'video', True)(video, by, *steps)
+  videoEnhance.__name__ = SR_vid.__name__
 
-  mm = getMM(sharedMemSize, False)
+  def imageBatch(slots, names, *args):
+    start = lambda nodes: begin(imNode, nodes, False)
+    return processBatch(stepFile + list(args), slots, names, start, config.batchPixels)
 
-  return mm, {
+  return {
     'lockInterface': lock,
     'image_enhance': enhance(imageEnhance, verbose=False),
-    'batch': enhance(imageEnhance, verbose=False),
-    'video_enhance': enhance(SR_vid),
-    'systemInfo': enhance(config.system)
+    'batch': enhance(imageBatch, verbose=False),
+    'video_enhance': enhance(videoEnhance),
+    'flush': flush
   }
 
 if __name__ == '__main__':
   mp.set_start_method('spawn')
   from worker import worker
-  taskInReceiver, taskInSender = mp.Pipe(False)
-  taskOutReceiver, taskOutSender = mp.Pipe(False)
-  noter, notifier = mp.Pipe(False)
-  stopEvent = mp.Event()
-  mp.Process(target=worker, args=(main, taskInReceiver, taskOutSender, notifier, stopEvent, isWindows), daemon=True).start()
+  workers = []
+  devices = startConfig['workers']
+  if type(devices) is int:
+    devices = [None] * max(1, devices)
+  for i, device in enumerate(devices):
+    taskInReceiver, taskInSender = mp.Pipe(False)
+    taskOutReceiver, taskOutSender = mp.Pipe(False)
+    noter, notifier = mp.Pipe(False)
+    stopEvent = mp.Event()
+    mp.Process(target=worker, args=(main, (i, device), taskInReceiver, taskOutSender, notifier, stopEvent), daemon=True).start()
+    workers.append((device, taskInSender, taskOutReceiver, noter, stopEvent))
   from server import runserver, config
-  mm = getMM(sharedMemSize)
-  run = runserver(taskInSender, taskOutReceiver, noter, stopEvent, mm, isWindows)
+  run = runserver(workers)
   host = '127.0.0.1'
   port = config['port']
   if len(sys.argv) > 1:
@@ -36,10 +36,20 @@ class Config():
         print('{} bytes of graphical memory available.'.format(self.getFreeMem()))
     except Exception as e:
       log.warning(e)
-    if self.cuda and self.deviceId >= torch.cuda.device_count():
+    self.checkDevice()
+
+  def checkDevice(self):
+    if self.cuda and not 0 <= self.deviceId < torch.cuda.device_count():
       log.warning(RuntimeWarning('GPU #{} not available, using GPU #0 instead'.format(self.deviceId)))
       self.deviceId = 0
 
+  def setDevice(self, deviceId):
+    """Use the GPU for this process, call before importing modules creating tensors."""
+    self.deviceId = deviceId
+    self.checkDevice()
+    if self.cuda:
+      torch.cuda.set_device(self.deviceId)
+
   def getConfig(self):
     return tuple(map(transform(self), ('crop_sr', 'crop_dn', 'crop_dns')))
 
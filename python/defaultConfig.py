@@ -14,11 +14,22 @@ defaultConfig = {
   'ensembleSR': (0,),
   'outDir': ('download',),
   'uploadDir': ('upload',),
+  'uploadFollow': (0, '上传视频时不等上传完成就开始处理，读到文件末尾后等待新数据的秒数，上传停顿超过此时间则输入被截断；0则等上传完成'),
   'logPath': ('.user/log.txt',),
+  'ffmpegLogPath': ('.user/ffmpeg.txt', 'ffmpeg输出的日志，进度行每秒最多记一行'),
   'opsPath': ('.user/ops.json',),
+  'profilePath': ('.user/profiles', '诊断配置中性能剖析结果的保存目录'),
+  'jobsPath': ('.user/jobs.json', '排队中的任务记录，重启后恢复视频任务'),
   'videoPreview': ('jpeg',),
+  'previewInterval': (1., '预览图最短的更新间隔秒数，图片放大时按已完成的分块更新预览'),
   'maxResultsKept': (1 << 10,),
-  'sharedMemSize': (100 * 2 ** 20, '前后台共享的内存文件交换区字节大小，要能装下一张输入或输出图片'),
+  'resultsPath': ('.user/results.db', '任务结果数据库，重启后客户端仍可取回结果'),
+  'resultTTL': (7 * 86400, '任务结果保留的秒数'),
+  'sharedMemSize': (100 * 2 ** 20, '前后台共享的内存文件交换区每段的字节大小，装不下的图片会另开新段'),
+  'batchSize': (8, '批量处理时每次送入后台的图片数'),
+  'batchPixels': (1 << 22, '批量处理时同尺寸图片合并推理，每批的最大像素数'),
+  'workers': (1, '后台工作进程数量，每个进程独占一块共享内存；也可以是显卡序号列表，每张显卡一个进程'),
   'port': (2333,),
-  'progressDetail': (False,)
+  'progressDetail': (False,),
+  'notifyInterval': (.1, '后台进度消息合并发送的间隔秒数，阶段切换和结果立即发送')
 }
\ No newline at end of file
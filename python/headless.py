@@ -0,0 +1,185 @@
+"""
+Batch processing in this process without the web server.
+Run from the repository root: python python/headless.py -s steps.json -o output inputs...
+Image steps are those of image_enhance, video steps start with decode and end with encode like video_enhance.
+"""
+# pylint: disable=E1101
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+from copy import deepcopy
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append('./python')
+from config import config
+config.videoPreview = '' # no previews to serve
+from progress import Node, loadInternal, saveInternal
+from logger import initLogging
+from worker import context, begin, flush, setWriters, log
+
+imageExts = {'.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif', '.tif', '.tiff'}
+videoExts = {'.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv', '.ts', '.m4v', '.wmv', '.mpg', '.mpeg'}
+stepFile = [{'op': 'file'}]
+isVideoSteps = lambda steps: steps[0].get('op') == 'decode'
+
+def listInputs(patterns, exts):
+  """(path, path relative to the directory or glob base) of files with the extensions, in order and without duplicates."""
+  seen = set()
+  for pattern in patterns:
+    if os.path.isdir(pattern):
+      base = pattern
+      paths = sorted(os.path.join(root, name) for root, _, names in os.walk(pattern) for name in names)
+    else:
+      base = os.path.dirname(pattern.split('*')[0].split('?')[0]) or '.'
+      paths = sorted(glob.glob(pattern, recursive=True))
+    for path in paths:
+      key = os.path.abspath(path)
+      if os.path.splitext(path)[1].lower() in exts and not key in seen and os.path.isfile(path):
+        seen.add(key)
+        yield path, os.path.relpath(path, base)
+
+class Manifest():
+  """Outcome of every input by its path, saved after each change so an interrupted run resumes where it stopped."""
+  def __init__(self, path):
+    self.path = path
+    self.entries = {}
+    if path and os.path.exists(path):
+      with open(path, 'r', encoding='utf-8') as fp:
+        self.entries = json.load(fp)
+
+  def stat(self, path):
+    s = os.stat(path)
+    return dict(size=s.st_size, mtime=s.st_mtime)
+
+  def done(self, path, output):
+    entry = self.entries.get(path)
+    return bool(entry) and entry['status'] == 'done' and entry['output'] == output\
+      and entry['source'] == self.stat(path) and os.path.exists(entry['result'])
+
+  def set(self, path, output, status, result=None):
+    self.entries[path] = dict(output=output, result=result or output, status=status, source=self.stat(path), time=time.time())
+
+  def save(self):
+    if not self.path:
+      return
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fp:
+      json.dump(self.entries, fp, ensure_ascii=False, indent=1)
+    os.replace(tmp, self.path)
+
+class Printer():
+  """Stands for the worker notifier, shows the progress notes."""
+  def __init__(self, onNote=None):
+    self.onNote = onNote
+
+  def send(self, note):
+    if self.onNote:
+      self.onNote(note)
+    elif 'exception' in note:
+      log.error(note['exception'])
+
+def setup(device=None, onNote=None, writers=4):
+  """Prepare the worker context to run steps in this process."""
+  initLogging(config.logPath, config.ffmpegLogPath)
+  if device is not None:
+    config.setDevice(device)
+  context.getFile = lambda path: path
+  context.inputs = None
+  context.slots = []
+  context.notifier = Printer(onNote)
+  context.stopFlag = Event()
+  setWriters(writers)
+  if os.path.exists(config.opsPath):
+    loadInternal(config.opsPath)
+
+def runImages(items, steps, onItem, jobs=4):
+  """Process (input, output) image pairs in chunks, images in the same shape of a chunk are stacked."""
+  from procedure import processBatch
+  imNode = Node({'op': 'image'}, learn=0)
+  start = lambda nodes: begin(imNode, nodes, False)
+  steps = deepcopy(steps)
+  if steps[-1].get('op') != 'output':
+    steps.append({'op': 'output'})
+  steps[-1]['writeBehind'] = True
+  with ThreadPoolExecutor(jobs) as pool:
+    for i in range(0, len(items), config.batchSize):
+      if context.stopFlag.is_set():
+        break
+      chunk = items[i:i + config.batchSize]
+      inputs, outputs = zip(*chunk)
+      for output in outputs:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+      try:
+        failed = set(processBatch(stepFile + deepcopy(steps), inputs, outputs, start, config.batchPixels, pool.map))
+      except Exception:
+        log.exception('batch from {} failed'.format(inputs[0]))
+        failed = set(outputs)
+      failed |= set(flush())
+      for item in chunk:
+        onItem(item, 'failed' if item[1] in failed else 'done')
+
+def runVideos(items, steps, onItem):
+  from video import SR_vid
+  for path, output in items:
+    if context.stopFlag.is_set():
+      break
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    videoSteps = deepcopy(steps)
+    videoSteps[-1]['file'] = output
+    try:
+      outputPath, _ = SR_vid(path, 'url', *videoSteps) # as url, the input is kept
+      onItem((path, output), 'done', outputPath)
+    except Exception:
+      log.exception('video {} failed'.format(path))
+      onItem((path, output), 'failed')
+
+def run(inputs, steps, outDir=None, manifest=None, jobs=4, device=None, onNote=None, onItem=None):
+  """
+  Process images or videos given by paths, directories or glob patterns with the steps,
+  outputs go to `outDir` with the same relative paths; inputs recorded as done in the manifest are skipped.
+  Returns the manifest entries.
+  """
+  setup(device, onNote, jobs)
+  outDir = outDir or config.outDir
+  video = isVideoSteps(steps)
+  manifest = Manifest(manifest if manifest is not None else os.path.join(outDir, '.manifest.json'))
+  items = [(path, os.path.join(outDir, relative)) for path, relative in listInputs(inputs, videoExts if video else imageExts)]
+  todo = [item for item in items if not manifest.done(*item)]
+  log.info('{} of {} inputs to process'.format(len(todo), len(items)))
+  def itemDone(item, status, result=None):
+    manifest.set(*item, status, result)
+    manifest.save()
+    onItem and onItem(item, status)
+  try:
+    (runVideos(todo, steps, itemDone) if video else runImages(todo, steps, itemDone, jobs))
+  finally:
+    saveInternal(config.opsPath)
+  return manifest.entries
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='MoePhoto batch processing without the web server')
+  parser.add_argument('inputs', nargs='+', help='image or video files, directories or glob patterns')
+  parser.add_argument('-s', '--steps', required=True, help='steps JSON or path of a JSON file')
+  parser.add_argument('-o', '--output', default=config.outDir, help='output directory')
+  parser.add_argument('-m', '--manifest', help='manifest path, default .manifest.json under the output directory')
+  parser.add_argument('-j', '--jobs', type=int, default=4, help='threads to decode and encode images')
+  parser.add_argument('-d', '--device', type=int, help='GPU ID')
+  args = parser.parse_args(argv)
+  if os.path.exists(args.steps):
+    with open(args.steps, 'r', encoding='utf-8') as fp:
+      steps = json.load(fp)
+  else:
+    steps = json.loads(args.steps)
+  count = [0, 0]
+  def onItem(item, status):
+    count[status != 'done'] += 1
+    print('{} {} -> {}'.format(status, *item), flush=True)
+  run(args.inputs, steps, args.output, args.manifest, args.jobs, args.device, onItem=onItem)
+  print('{} done, {} failed'.format(*count))
+  return 1 if count[1] else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,5 +1,8 @@
 # pylint: disable=E1101
 import time
+import threading
+from os.path import exists
+from collections import defaultdict
 from copy import copy
 from functools import reduce
 from itertools import chain
@@ -13,7 +16,7 @@ from torchvision.transforms.functional import to_tensor
 import numpy as np
 from PIL import Image
 from config import config
-from progress import updateNode
+from progress import updateNode, addTiles
 import logging
 
 def getAnchors(s, ns, l, pad, af, sc):
@@ -70,9 +73,10 @@ def solveRam(m, c, k):
     else:
       return (np.sqrt(k[1] * k[1] + 4 * k[2] * v) - k[1]) / 2 / k[2]
 
-def prepare(shape, ram, opt, pad, sc, align=8, cropsize=0):
+def prepare(shape, ram, opt, pad, sc, align=8, cropsize=0, batch=False):
   *_, c, h, w = shape
-  n = solveRam(ram, opt.fixChannel or c, opt.ramCoef / shape[0] if shape[0] else 1.)
+  count = shape[0] * c if batch else shape[0]
+  n = solveRam(ram, opt.fixChannel or c, opt.ramCoef / count if count else 1.)
   af = alignF[align]
   s = af(minSize + pad * 2)
   if n < s * s:
@@ -130,19 +134,20 @@ def blend(r, x, lt, pad, dim, blend):
   b = bx + blend * (b - bx)
   return torch.cat([b, c], dim), x.narrow(dim, start, ls)
 
-def prepareOpt(opt, shape):
+def prepareOpt(opt, shape, batch=False):
   sc, pad = opt.scale, opt.padding
   padSc = int(pad * sc)
   if opt.iterClip is None or opt.count > 28 or shape[0] != opt.outShape[0]:
     try:
-      freeMem = config.calcFreeMem()
+      freeMem = config.calcFreeMem() * opt.ramRatio
     except Exception:
       raise MemoryError('Can not calculate free memory.')
     opt.count = 0
     if opt.ensemble > 0:
       opt2 = copy(opt)
-      opt2.iterClip, opt2.padImage, opt2.unpad, *_ = prepare(transposeShape(shape), freeMem, opt, pad, sc, opt.align, opt.cropsize)
-    opt.iterClip, opt.padImage, opt.unpad, outShape, opt.blend = prepare(shape, freeMem, opt, pad, sc, opt.align, opt.cropsize)
+      opt2.preview = None # the transposed passes are not previewed
+      opt2.iterClip, opt2.padImage, opt2.unpad, *_ = prepare(transposeShape(shape), freeMem, opt, pad, sc, opt.align, opt.cropsize, batch)
+    opt.iterClip, opt.padImage, opt.unpad, outShape, opt.blend = prepare(shape, freeMem, opt, pad, sc, opt.align, opt.cropsize, batch)
     if opt.outShape is None:
       opt.outShape = [1, *opt.oShape[1:-2], int(sc * shape[-2]), int(sc * shape[-1])] if opt.oShape else outShape
     opt.outShape = list(opt.outShape)
@@ -154,20 +159,154 @@ def prepareOpt(opt, shape):
     opt.count += 1
   return sc, padSc
 
+def stackSqueeze(opt, x):
+  """
+  A stack (N, C, H, W) of images for a model taking single images runs as one model batch,
+  each image unsqueezed the way `opt.unsqueeze` does; returns None for other inputs.
+  """
+  if x.dim() != 4:
+    return None
+  shape = opt.unsqueeze(x[0]).shape
+  if len(shape) != 4:
+    return None
+  n = x.size(0)
+  return (lambda r: r.reshape(n, -1, *r.shape[-2:])), (lambda t: t.reshape(-1, *shape[1:]))
+
+def countTiles(opt, shape, freeMem):
+  """
+  Tiles doCrop would cut an input of `shape` into with `freeMem` for the plan, with all ensemble passes;
+  shape (N, C, H, W) is a stack of images.
+  """
+  iterClip = prepare(shape, freeMem, opt, opt.padding, opt.scale, opt.align, opt.cropsize, len(shape) > 3)[0]
+  return sum(1 for _ in iterClip()) * (opt.ensemble + 1)
+
+def throttle(interval, last=0):
+  """A function telling if `interval` seconds have passed since it last said so."""
+  def due():
+    nonlocal last
+    now = time.perf_counter()
+    if now - last < interval:
+      return False
+    last = now
+    return True
+  return due
+
+class TilePreview():
+  """
+  Downscaled composite of the tiles doCrop finished so far, the part not finished yet shows the input;
+  handed to `write` as an 8 bit (H, W, C) array at most once per `interval` seconds.
+  """
+  def __init__(self, write, interval, size=1024):
+    self.write = write
+    self.due = throttle(interval, time.perf_counter())
+    self.size = size
+    self.canvas = None
+    self.pending = []
+
+  def begin(self, x, outShape):
+    *_, h, w = outShape
+    s = min(1., self.size / max(h, w))
+    self.sh, self.sw = s, s
+    self.h, self.w = max(1, round(h * s)), max(1, round(w * s))
+    x = x.reshape(1, -1, *x.shape[-2:]).float()
+    self.canvas = F.interpolate(x, size=(self.h, self.w), mode='area')
+    self.pending = []
+
+  def add(self, out, top, bottom, left, right):
+    self.pending.append((top, bottom, left, right))
+    if self.due():
+      self.flush(out)
+
+  def flush(self, out):
+    canvas = self.canvas
+    for top, bottom, left, right in self.pending:
+      t, l = min(self.h - 1, int(top * self.sh)), min(self.w - 1, int(left * self.sw))
+      b, r = max(t + 1, min(self.h, round(bottom * self.sh))), max(l + 1, min(self.w, round(right * self.sw)))
+      tile = out[..., top:bottom, left:right].reshape(1, -1, bottom - top, right - left).float()
+      if tile.size(1) != canvas.size(1):
+        continue
+      canvas[..., t:b, l:r] = F.interpolate(tile, size=(b - t, r - l), mode='area')
+    self.pending = []
+    self.write(toOutput8(toFloat(canvas[0])))
+
+class PreviewEncoder():
+  """
+  Previews of video frames at most once per `interval` seconds, encoded by `write` on a background thread;
+  frames are scaled down and quantized on their device, then copied into 2 reused host buffers,
+  only the latest frame waits while the encoder is busy.
+  """
+  def __init__(self, write, interval, size=2048):
+    self.write = write
+    self.due = throttle(interval)
+    self.size = size
+    self.buffers = [None, None]
+    self.latest = None # index of the buffer waiting for encoding
+    self.busy = None # index of the buffer being encoded
+    self.lock = threading.Lock()
+    self.ready = threading.Event()
+    self.thread = None
+
+  def __call__(self, im, bgr=False):
+    if im is None or not self.due():
+      return
+    x = im.detach().reshape(-1, *im.shape[-2:])
+    *_, h, w = x.shape
+    s = self.size / max(h, w)
+    if s < 1:
+      x = resizeByTorch(x, max(1, round(w * s)), max(1, round(h * s)))
+    if bgr and x.size(0) == 3:
+      x = x.flip(0)
+    x = (x.float() * 256).clamp_(0, 255).to(torch.uint8).permute(1, 2, 0)
+    with self.lock:
+      i = 1 if self.busy == 0 else 0
+      if self.buffers[i] is None or self.buffers[i].shape != x.shape:
+        self.buffers[i] = torch.empty(x.shape, dtype=torch.uint8, pin_memory=x.is_cuda)
+      self.buffers[i].copy_(x)
+      self.latest = i
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run, name='previewEncoder', daemon=True)
+      self.thread.start()
+    self.ready.set()
+
+  def run(self):
+    while True:
+      self.ready.wait()
+      self.ready.clear()
+      with self.lock:
+        i, self.latest = self.latest, None
+        self.busy = i
+      if i is None:
+        continue
+      try:
+        self.write(self.buffers[i].numpy())
+      except Exception:
+        log.exception('encoding preview failed')
+      finally:
+        with self.lock:
+          self.busy = None
+
 def doCrop(opt, x, *args, **_):
-  sc, padSc = prepareOpt(opt, x.shape)
+  stack = stackSqueeze(opt, x)
+  squeeze, unsqueeze = stack or (opt.squeeze, opt.unsqueeze)
+  sc, padSc = prepareOpt(opt, x.shape, bool(stack))
   bl = opt.blend
   opt.outShape[0] = x.size(0)
-  x = opt.padImage(opt.unsqueeze(x))
+  preview = getattr(opt, 'preview', None)
+  if preview:
+    preview.begin(x, opt.outShape)
+  x = opt.padImage(unsqueeze(x))
   tmp_image = x.new_empty(opt.outShape)
 
   for top, bottom, left, right, topT, leftT, bsc, rsc in opt.iterClip():
+    addTiles()
     s = x[..., top:bottom, left:right]
-    r = opt.squeeze(opt(s, *args))
+    r = squeeze(opt(s, *args))
     t = tmp_image[..., int(top * sc):bsc, int(left * sc):rsc]
     q, _ = blend(*blend(opt.unpad(r), t, topT, padSc, -2, bl.t()), leftT, padSc, -1, bl)
     *_, h, w = q.shape
     tmp_image[..., bsc - h:bsc, rsc - w:rsc] = q
+    if preview:
+      preview.add(tmp_image, bsc - h, bsc, rsc - w, rsc)
 
   return tmp_image.detach()
 
@@ -178,7 +317,7 @@ def resize(opt, out, pos=0, nodes=[], h=1, w=1):
   def f(im):
     nonlocal h, w
     if opt['update']:
-      _, h, w = im.shape
+      h, w = im.shape[-2:]
       oriLoad = h * w
       h = round(h * opt['scaleH']) if 'scaleH' in opt else opt['height']
       w = round(w * opt['scaleW']) if 'scaleW' in opt else opt['width']
@@ -275,35 +414,46 @@ def writeFile(image, name, context, *args):
   image.save(name, *args)
   return name
 
+def readImage(file, context):
+  image = Image.open(file)
+  context.imageMode = image.mode
+  if image.mode == 'P':
+    context.palette = image
+    image = image.convert('RGB')
+  image = np.array(image)
+  if context.imageMode == 'RGBA':
+    context.imageMode, image = dedupeAlpha(image)
+  if len(image.shape) == 2:
+    return image.reshape(*image.shape, 1)
+  if image.shape[2] == 3 or image.shape[2] == 4:
+    return image
+  else:
+    raise RuntimeError('Unknown image format')
+
+def setLoad(nodes, image, mode):
+  """Scale loads of the nodes by the size of the image, and report the image summary."""
+  for n in nodes:
+    n.multipleLoad(image.size)
+    updateNode(n)
+  if len(nodes):
+    p = nodes[0].parent
+    updateNode(p)
+    p.callback(p, dict(mode=mode, shape=list(image.shape[:2])))
+
 def readFile(nodes=[], context=None):
   def f(file):
-    image = Image.open(file)
-    context.imageMode = image.mode
-    if image.mode == 'P':
-      context.palette = image
-      image = image.convert('RGB')
-    image = np.array(image)
-    if context.imageMode == 'RGBA':
-      context.imageMode, image = dedupeAlpha(image)
-    summary = dict(mode=context.imageMode, shape=list(image.shape[:2]))
-    for n in nodes:
-      n.multipleLoad(image.size)
-      updateNode(n)
-    if len(nodes):
-      p = nodes[0].parent
-      updateNode(p)
-      p.callback(p, summary)
-    if len(image.shape) == 2:
-      return image.reshape(*image.shape, 1)
-    if image.shape[2] == 3 or image.shape[2] == 4:
-      return image
-    else:
-      raise RuntimeError('Unknown image format')
+    image = readImage(file, context)
+    setLoad(nodes, image, context.imageMode)
+    return image
   return f
 
 def getStateDict(path):
   if not path in weightCache:
-    weightCache[path] = torch.load(path, map_location='cpu')
+    if randomWeights and not exists(path):
+      log.warning('{} not found, using random weights'.format(path))
+      weightCache[path] = defaultdict(type(None)) # every module of it stays randomly initialized
+    else:
+      weightCache[path] = torch.load(path, map_location='cpu')
   return weightCache[path]
 
 def castModel(model):
@@ -321,10 +471,10 @@ def initModel(opt, weights=None, key=None, f=lambda opt: opt.modelDef(), args=[]
     return castModel(modelCache[key])
   log.info('loading model {}'.format(opt.model))
   model = f(opt, *args)
+  if type(weights) == str:
+    weights = getStateDict(weights)
   if weights:
     log.info('reloading weights')
-    if type(weights) == str:
-      weights = getStateDict(weights)
     model.load_state_dict(weights)
   for param in model.parameters():
     param.requires_grad_(False)
@@ -349,9 +499,9 @@ def transposeShape(shape):
 
 def extractAlpha(t):
   def f(im):
-    if im.shape[0] == 4:
-      t['im'] = im[3]
-      return im[:3]
+    if im.shape[-3] == 4:
+      t['im'] = im[..., 3, :, :]
+      return im[..., :3, :, :]
     else:
       return im
   return f
@@ -359,9 +509,9 @@ def extractAlpha(t):
 def mergeAlpha(t):
   def f(im):
     if len(t):
-      image = torch.empty((4, *im.shape[1:]), dtype=im.dtype, device=im.device)
-      image[:3] = im
-      image[3] = t['im']
+      image = torch.empty((*im.shape[:-3], 4, *im.shape[-2:]), dtype=im.dtype, device=im.device)
+      image[..., :3, :, :] = im
+      image[..., 3, :, :] = t['im']
       return image
     else:
       return im
@@ -384,6 +534,8 @@ class Option():
     self.model = path
     self.outShape, self.oShape = None, None
     self.iterClip = None
+    self.ramRatio = 1. # share of free memory the tile plan is sized by, smaller for smaller tiles
+    self.preview = None # TilePreview of the tiles done
     self.prepare = identity
     self.squeeze = lambda x: x.squeeze(0)
     self.unsqueeze = lambda x: x.unsqueeze(0)
@@ -394,6 +546,25 @@ class Option():
       out = out[-1]
     return out
 
+def getGrid(h, w, dtype, device, d=0):
+  """
+  Returns the normalized base sampling grid (1, h, w, 2) and the flow scale (2,),
+  shared by all warps of the same size, type and normalization (pixel / (size - d)).
+  """
+  key = (h, w, dtype, device, d)
+  if not key in gridCache:
+    kx, ky = 2. / (w - d), 2. / (h - d)
+    x = torch.arange(w, dtype=dtype, device=device) * kx - 1
+    y = torch.arange(h, dtype=dtype, device=device) * ky - 1
+    grid = torch.stack((x.view(1, w).expand(h, w), y.view(h, 1).expand(h, w)), 2).unsqueeze(0)
+    gridCache[key] = (grid, torch.tensor([kx, ky], dtype=dtype, device=device))
+  return gridCache[key]
+
+def warp(img, flow, d=0, padding_mode='zeros'):
+  grid, k = getGrid(*flow.shape[-2:], flow.dtype, flow.device, d)
+  grid = torch.addcmul(grid, flow.permute(0, 2, 3, 1), k) # grid + flow * k in one pass
+  return F.grid_sample(img, grid, align_corners=True, padding_mode=padding_mode, mode='bilinear')
+
 offload = lambda b: [t.cpu() if isinstance(t, torch.Tensor) else t for t in b] if type(b) == list else b.cpu()
 load2device = lambda b, device: b.to(device) if isinstance(b, torch.Tensor) else (b if b is None else [load2device(t, device) for t in b])
 
@@ -543,6 +714,8 @@ previewPath = config.outDir + '/.preview.{}'.format(previewFormat if previewForm
 log = logging.getLogger('Moe')
 modelCache = {}
 weightCache = {}
+randomWeights = False # missing checkpoints leave models randomly initialized, for benchmarks
+gridCache = {}
 fCleanCache = lambda x: torch.cuda.empty_cache() or x
 genNameByTime = lambda: '{}/output_{}.png'.format(outDir, int(time.time()))
 padImageReflect = torch.nn.ReflectionPad2d
@@ -553,14 +726,15 @@ minSize = 28
 alignF = { 1: identity }
 alignF.update((1 << k, ceilBy(1 << k)) for k in (3, 4, 5, 6, 7, 9))
 resizeByTorch = lambda x, width, height, mode='bilinear':\
-  F.interpolate(x.unsqueeze(0), size=(height, width), mode=mode, align_corners=False).squeeze()
-clean = lambda: torch.cuda.empty_cache()
+  F.interpolate(x.view(-1, *x.shape[-3:]), size=(height, width), mode=mode, align_corners=False).view(*x.shape[:-2], height, width)
+clean = lambda: gridCache.clear() or torch.cuda.empty_cache()
 BGR2RGB = lambda im: np.stack([im[:, :, 2], im[:, :, 1], im[:, :, 0]], axis=2)
-BGR2RGBTorch = lambda im: torch.stack([im[2], im[1], im[0]])
+BGR2RGBTorch = lambda im: im[..., [2, 1, 0], :, :]
 toOutput8 = toOutput(8)
 dedupeAlpha = lambda x: ('RGB', x[:, :, :3]) if (255 - x[:, :, 3]).astype(dtype=np.float32).sum() < 1 else ('RGBA', x)
 strengthOp = lambda x, inp, s=1: x if s == 1 else s * x + (1 - s) * inp
 apply = lambda v, f: f(v)
+stack = lambda f: lambda images: torch.stack([f(im) for im in images])
 transpose = lambda x: x.transpose(-1, -2)
 flip = lambda x: x.flip(-1)
 flip2 = lambda x: x.flip(-1, -2)
@@ -569,7 +743,15 @@ getTransposedOpt = lambda opt: opt.transposedOpt
 trans = [transpose, flip, flip2, combine(flip, transpose), combine(transpose, flip), combine(transpose, flip, transpose), combine(flip2, transpose)]
 transInv = [transpose, flip, flip2, trans[4], trans[3], trans[5], trans[6]]
 which = [getTransposedOpt, identity, identity, getTransposedOpt, getTransposedOpt, identity, getTransposedOpt]
-ensemble = lambda opt: lambda x: reduce((lambda v, t: (v + t[2](doCrop(t[3](opt), t[1](x)))).detach()), zip(range(opt.ensemble), trans, transInv, which), doCrop(opt, x))
+def ensemble(opt):
+  def f(x):
+    v = doCrop(opt, x)
+    preview, opt.preview = getattr(opt, 'preview', None), None # only the untransformed pass is previewed
+    try:
+      return reduce((lambda v, t: (v + t[2](doCrop(t[3](opt), t[1](x)))).detach()), zip(range(opt.ensemble), trans, transInv, which), v)
+    finally:
+      opt.preview = preview
+  return f
 split = lambda *ps: lambda x: tuple(split(*ps[1:])(c) for c in x.split(ps[0], x.ndim - len(ps))) if len(ps) else x
 flat = lambda x: tuple(chain(*(flat(t) for t in x))) if len(x) and type(x[0]) is tuple else x
 extend = lambda out, res, off=False: None if res is None else out.extend(tuple(offload(res) if off else res))
\ No newline at end of file
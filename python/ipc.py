@@ -0,0 +1,77 @@
+import sys
+import time
+from threading import Condition, Thread
+from gevent import sleep
+from gevent.socket import wait_read
+isWindows = sys.platform[:3] == 'win'
+pollInterval = .02
+
+def waitReadable(conn, timeout=None):
+  """Block the current greenlet until `conn` has data, other greenlets keep running."""
+  if isWindows: # pipes are not selectable on Windows
+    while not conn.poll():
+      sleep(pollInterval)
+  else:
+    wait_read(conn.fileno(), timeout)
+
+def receive(conn):
+  while not conn.poll():
+    waitReadable(conn)
+  return conn.recv()
+
+class Notifier():
+  """
+  Coalesces notes sent over `conn` within `interval` seconds, later values supersede earlier ones of the same keys;
+  a stage change, a result or an exception goes out at once with the pending values, the rest at most once per interval;
+  values held back are sent by one flusher thread when their interval ends.
+  """
+  urgent = ('result', 'exception')
+
+  def __init__(self, conn, interval):
+    self.conn = conn
+    self.interval = interval
+    self.pending = {}
+    self.stage = None
+    self.last = 0
+    self.due = None # when the flusher sends the pending values
+    self.cond = Condition()
+    self.thread = None
+
+  def send(self, note):
+    with self.cond:
+      self.pending.update(note)
+      stage = note.get('stage', self.stage)
+      now = time.perf_counter()
+      if stage != self.stage or any(k in note for k in self.urgent) or now - self.last >= self.interval:
+        self.stage = stage
+        self.sendPending(now)
+      elif self.due is None:
+        self.due = self.last + self.interval
+        if self.thread is None:
+          self.thread = Thread(target=self.run, name='notifier', daemon=True)
+          self.thread.start()
+        self.cond.notify()
+
+  def sendPending(self, now):
+    self.due = None
+    if len(self.pending):
+      self.conn.send(self.pending)
+      self.pending = {}
+    self.last = now
+
+  def run(self):
+    with self.cond:
+      while True:
+        if self.due is None:
+          self.cond.wait()
+          continue
+        now = time.perf_counter()
+        if now < self.due:
+          self.cond.wait(self.due - now)
+        else:
+          self.sendPending(now)
+
+  def flush(self):
+    """Send the pending values now, before the task result."""
+    with self.cond:
+      self.sendPending(time.perf_counter())
@@ -1,8 +1,13 @@
+import re
 import json
+import atexit
 import logging
 import logging.config
+import threading
 import time
 import os
+from queue import Queue, Full, Empty
+from logging.handlers import QueueHandler, RotatingFileHandler
 
 class JSONFormatter(logging.Formatter):
   converter = time.gmtime
@@ -38,7 +43,139 @@ class LocalFormatter(logging.Formatter):
     else:
       return '{}|{}|{}'.format(time, r.name, message)
 
-def initLogging(logFile=None):
+class SampleFilter(logging.Filter):
+  """Passes progress lines matching `pattern` at most once per `interval` seconds, and all other lines."""
+  def __init__(self, interval=1., pattern=r'\s*(frame|size)='):
+    super(SampleFilter, self).__init__()
+    self.interval = interval
+    self.pattern = re.compile(pattern)
+    self.last = 0
+
+  def filter(self, r):
+    if not self.pattern.match(str(r.msg)):
+      return True
+    now = time.monotonic()
+    if now - self.last < self.interval:
+      return False
+    self.last = now
+    return True
+
+class ExcludeFilter(logging.Filter):
+  """Drops records of the named logger and its children."""
+  def filter(self, r):
+    return not super(ExcludeFilter, self).filter(r)
+
+class DropQueueHandler(QueueHandler):
+  """
+  Puts records into a bounded queue without blocking the logging thread, records are counted and dropped when it's full;
+  formatting is left to the listener thread.
+  """
+  def __init__(self, queue):
+    super(DropQueueHandler, self).__init__(queue)
+    self.dropped = 0
+
+  def prepare(self, record):
+    return record
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except Full:
+      self.dropped += 1
+
+class BatchHandler():
+  """Mixin of stream handlers writing a batch of records at once with a single flush."""
+  def emitBatch(self, records):
+    lines = []
+    for r in records:
+      if r.levelno >= self.level and self.filter(r):
+        try:
+          lines.append(self.format(r))
+        except Exception:
+          self.handleError(r)
+    if not lines:
+      return
+    text = self.terminator.join(lines) + self.terminator
+    self.acquire()
+    try:
+      self.write(text)
+    finally:
+      self.release()
+
+  def write(self, text):
+    self.stream.write(text)
+    self.flush()
+
+class BatchStreamHandler(BatchHandler, logging.StreamHandler): pass
+
+class BatchFileHandler(BatchHandler, RotatingFileHandler):
+  def write(self, text):
+    if self.stream is None:
+      self.stream = self._open()
+    if self.maxBytes > 0 and self.stream.tell() + len(text.encode(self.encoding or 'utf-8')) >= self.maxBytes:
+      self.doRollover()
+    super(BatchFileHandler, self).write(text)
+
+class BatchListener():
+  """Drains the queue of `source` on a thread, hands records to the handlers in batches of at most `batchSize`."""
+  def __init__(self, source, handlers, batchSize=256):
+    self.source = source
+    self.queue = source.queue
+    self.handlers = handlers
+    self.batchSize = batchSize
+    self.reported = 0
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name='logListener', daemon=True)
+    self.thread.start()
+
+  def run(self):
+    stopped = False
+    while not stopped:
+      records = [self.queue.get()]
+      while len(records) < self.batchSize:
+        try:
+          records.append(self.queue.get_nowait())
+        except Empty:
+          break
+      stopped = None in records
+      records = [r for r in records if r is not None]
+      dropped = self.source.dropped - self.reported
+      if dropped:
+        self.reported += dropped
+        records.append(logging.makeLogRecord(dict(name='logger', levelno=logging.WARNING, levelname='WARNING',
+          msg='{} log records dropped for the full queue'.format(dropped), module='logger')))
+      for handler in self.handlers:
+        if isinstance(handler, BatchHandler):
+          handler.emitBatch(records)
+        else:
+          for r in records:
+            if r.levelno >= handler.level:
+              handler.handle(r)
+
+  def stop(self, timeout=5):
+    """Write out the queued records."""
+    if self.thread:
+      try:
+        self.queue.put(None, timeout=timeout)
+        self.thread.join(timeout)
+      except Full:
+        pass
+      self.thread = None
+
+def indexedPath(path, index):
+  """Log file of the process `index`, the first process keeps `path`, so processes never share a file."""
+  if not (path and index):
+    return path
+  base, ext = os.path.splitext(path)
+  return '{}.{}{}'.format(base, index, ext)
+
+def initLogging(logFile=None, ffmpegFile=None, queueSize=1 << 12, sampleInterval=1.):
+  """
+  Log to console and `logFile` in JSON through a bounded queue, records are formatted and written in batches
+  on a listener thread; ffmpeg output goes to logger 'ffmpeg' with progress lines sampled, kept in `ffmpegFile`.
+  """
   LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -48,12 +185,34 @@ def initLogging(logFile=None):
       },
       'local': {
         '()': LocalFormatter
+      },
+      'plain': {
+        'format': '%(asctime)s %(message)s'
+      }
+    },
+    'filters': {
+      'ffmpeg': {
+        'name': 'ffmpeg'
+      },
+      'notFFmpeg': {
+        '()': ExcludeFilter,
+        'name': 'ffmpeg'
+      },
+      'sample': {
+        '()': SampleFilter,
+        'interval': sampleInterval
       }
     },
     'handlers': {
       'console': {
-        'class': 'logging.StreamHandler',
+        '()': BatchStreamHandler,
         'formatter': 'local',
+        'filters': ['notFFmpeg']
+      }
+    },
+    'loggers': {
+      'ffmpeg': {
+        'filters': ['sample']
       }
     },
     'root': {
@@ -66,14 +225,38 @@ def initLogging(logFile=None):
       os.makedirs(os.path.dirname(logFile))
 
     LOGGING['handlers']['logFile'] = {
-      'class': 'logging.handlers.RotatingFileHandler',
+      '()': BatchFileHandler,
       'filename': logFile,
       'mode': 'w',
       'backupCount': 1,
       'maxBytes': 1 << 24,
       'encoding': 'utf-8',
-      'formatter': 'JSON'
+      'formatter': 'JSON',
+      'filters': ['notFFmpeg']
     }
     LOGGING['root']['handlers'].append('logFile')
+  if ffmpegFile:
+    if not os.path.exists(os.path.dirname(ffmpegFile)):
+      os.makedirs(os.path.dirname(ffmpegFile))
+    LOGGING['handlers']['ffmpegFile'] = {
+      '()': BatchFileHandler,
+      'filename': ffmpegFile,
+      'mode': 'w',
+      'backupCount': 1,
+      'maxBytes': 1 << 24,
+      'encoding': 'utf-8',
+      'formatter': 'plain',
+      'filters': ['ffmpeg']
+    }
+    LOGGING['root']['handlers'].append('ffmpegFile')
   logging.config.dictConfig(LOGGING)
+  root = logging.getLogger()
+  handlers = root.handlers[:]
+  for handler in handlers:
+    root.removeHandler(handler)
+  queueHandler = DropQueueHandler(Queue(queueSize))
+  root.addHandler(queueHandler)
+  listener = BatchListener(queueHandler, handlers)
+  listener.start()
+  atexit.register(listener.stop)
   return logging
\ No newline at end of file
@@ -1,14 +1,16 @@
 # pylint: disable=E1101
+from copy import deepcopy
 from functools import reduce
-import numpy as np
+from types import SimpleNamespace
 from config import config
-from progress import Node
+from progress import Node, ops, predictCost, timeStage
 from imageProcess import (
-  toFloat, toOutput, toOutput8, toTorch, toNumPy, toBuffer,
-  readFile, writeFile,
+  toFloat, toOutput, toTorch, toNumPy, toBuffer,
+  readFile, readImage, setLoad, writeFile, stack,
   BGR2RGB, BGR2RGBTorch, RGBFilter,
-  resize, restrictSize,
-  apply, identity, previewFormat, previewPath
+  resize,
+  apply, identity, previewFormat, previewPath, log,
+  Option, countTiles, TilePreview, PreviewEncoder
 )
 import runSR
 import runDN
@@ -16,12 +18,13 @@ import dehaze
 import videoSR
 import ESTRNN
 import IFRNet
-from worker import context
+from worker import context, writeShared, writeBehind
 
 videoOps = {'slomo', 'VSR', 'demob'}
 applyNonNull = lambda v, f: NonNullWrap(f)(v)
 NonNullWrap = lambda f: lambda x: f(x) if not x is None else None
 newNode = lambda opt, op, load=1, total=1: Node(op, load, total, name=opt.get('name', None))
+conversion = lambda f: timeStage('conversion', f)
 
 def convertValues(T, o, keys):
   for key in keys:
@@ -33,20 +36,20 @@ def appendFuncs(f, node, funcs, wrap=True):
   funcs.append(NonNullWrap(g) if wrap else g)
   return node
 
-fPreview = [
-  0,
-  toFloat,
-  toOutput8,
-  (lambda im: im.astype(np.uint8)),
-  0,
-  lambda im: writeFile(im, context.shared, context, previewFormat),
-  lambda *_: context.root.trace(0, preview=previewPath, fileSize=context.shared.tell())]
-funcPreview = lambda im: reduce(applyNonNull, fPreview, im)
+previewState = SimpleNamespace(imageMode='RGB')
+writePreviewSlot = lambda im: writeShared(lambda f: writeFile(im, f, previewState, previewFormat), im.nbytes + (1 << 16))
+
+def writePreview(im):
+  context.root.trace(0, preview=previewPath, slot=writePreviewSlot(im))
+
+# sent as a bare note from the encoder thread, tracing progress there would race with the frames
+sendPreview = lambda im: context.notifier.send({'preview': previewPath, 'slot': writePreviewSlot(im)})
+videoPreview = PreviewEncoder(sendPreview, config.previewInterval)
 
 def procInput(source, bitDepth, fs, out):
   out['load'], out['sf']  = 1, 1
   node = Node({'op': 'toTorch', 'bits': bitDepth})
-  fs.append(NonNullWrap(node.bindFunc(toTorch(bitDepth, config.dtype(), config.device()))))
+  fs.append(NonNullWrap(node.bindFunc(conversion(toTorch(bitDepth, config.dtype(), config.device())))))
   return fs, [node], out
 
 def procDN(opt, out, *_):
@@ -57,7 +60,7 @@ def procDN(opt, out, *_):
 def convertChannel(out):
   out['channel'] = 0
   fs=[]
-  return fs, [appendFuncs(BGR2RGBTorch, Node(dict(op='Channel')), fs)]
+  return fs, [appendFuncs(conversion(BGR2RGBTorch), Node(dict(op='Channel')), fs)]
 
 def procSR(opt, out, *_):
   load = out['load']
@@ -111,35 +114,34 @@ def procOutput(opt, out, *_):
   node0 = Node(dict(op='toFloat'), load)
   bitDepthOut = out['bitDepth']
   node1 = newNode(opt, dict(op='toOutput', bits=bitDepthOut), load)
-  fOutput = node1.bindFunc(toOutput(bitDepthOut))
+  fOutput = node1.bindFunc(conversion(toOutput(bitDepthOut)))
   fTrace = lambda x: context.root.trace(1 / out['sf']) or x
-  fs = [NonNullWrap(node0.bindFunc(toFloat)), NonNullWrap(fOutput)]
+  fFloat = node0.bindFunc(conversion(toFloat))
+  fs = [NonNullWrap(fFloat), NonNullWrap(fOutput)]
   ns = [node0, node1]
   if out['source']:
-    fPreview[0] = restrictSize(2048)
-    fs1 = [node0.bindFunc(toFloat), fOutput]
+    fs1 = [fFloat, fOutput]
     if previewFormat:
+      preview = timeStage('preview', videoPreview)
+      bgr = bool(out['channel'])
       def o(im):
         res = reduce(applyNonNull, fs1, im)
-        funcPreview(im)
+        preview(im, bgr)
         return [res]
     else:
       o = lambda im: [reduce(applyNonNull, fs1, im)]
     fs = [o, fTrace]
-    if out['channel']:
-      fPreview[4] = BGR2RGB
-    else:
-      fPreview[4] = identity
-      ns.append(appendFuncs(BGR2RGB, Node(dict(op='Channel')), fs1, False))
+    if not out['channel']:
+      ns.append(appendFuncs(conversion(BGR2RGB), Node(dict(op='Channel')), fs1, False))
       out['channel'] = 1
-    ns.append(appendFuncs(toBuffer(bitDepthOut), Node(dict(op='toBuffer', bits=bitDepthOut), load), fs1, False))
+    ns.append(appendFuncs(conversion(toBuffer(bitDepthOut)), Node(dict(op='toBuffer', bits=bitDepthOut), load), fs1, False))
   return fs, ns, out
 
 procs = dict(
   file=(lambda _, _0, nodes:
     procInput('file', 8, [context.getFile, readFile(nodes, context)], dict(bitDepth=8, channel=0, source=0))),
   buffer=(lambda opt, *_:
-    procInput('buffer', opt['bitDepth'], [toNumPy(opt['bitDepth'])], dict(bitDepth=opt['bitDepth'], channel=1, source=1))),
+    procInput('buffer', opt['bitDepth'], [conversion(toNumPy(opt['bitDepth']))], dict(bitDepth=opt['bitDepth'], channel=1, source=1))),
   DN=procDN, SR=procSR, output=procOutput, slomo=procSlomo,
   dehaze=procDehaze, resize=procResize, VSR=procVSR, demob=procDemob
   )
@@ -149,34 +151,42 @@ stepOpts = dict(
   resize={'toInt': ['width', 'height'], 'toFloat': ['scaleW', 'scaleH']},
   DN={'toFloat': ['strength'], 'getOpt': runDN},
   dehaze={'toFloat': ['strength'], 'getOpt': dehaze},
-  slomo={'toInt': ['ensemble'], 'toFloat': ['sf', 'high', 'low'], 'isEnabled': ['dedupe'], 'getOpt': IFRNet},
+  slomo={'toInt': ['ensemble'], 'toFloat': ['sf', 'high', 'low', 'motion'], 'isEnabled': ['dedupe', 'adaptive'], 'getOpt': IFRNet},
   VSR={'getOpt': videoSR},
   demob={'getOpt': ESTRNN}
 )
-def genProcess(steps, root=True, outType=None):
+def prepareSteps(steps):
+  """Convert values and build the options of root steps in place, the steps can then be passed to genProcess many times."""
+  stepOffset = 0 if steps[0]['op'] == 'file' else 2
+  for i, opt in enumerate(steps):
+    opt['name'] = i + stepOffset
+    if opt['op'] in stepOpts:
+      stepOpt = stepOpts[opt['op']]
+      convertValues(int, opt, stepOpt.get('toInt', []))
+      convertValues(float, opt, stepOpt.get('toFloat', []))
+      convertValues(lambda obj: obj.get('enable', 0), opt, stepOpt.get('isEnabled', []))
+      if 'getOpt' in stepOpt:
+        opt['opt'] = stepOpt['getOpt'].getOpt(opt)
+  if steps[-1]['op'] != 'output':
+    steps.append(dict(op='output'))
+  config.getFreeMem(True)
+  return steps
+
+def genProcess(steps, root=True, outType=None, batch=False, prepared=False):
   funcs=[]
   nodes=[]
+  outputAt = (0, 0)
   last = identity
   rf = lambda im: reduce(apply, funcs, im)
   if root:
-    stepOffset = 0 if steps[0]['op'] == 'file' else 2
-    for i, opt in enumerate(steps):
-      opt['name'] = i + stepOffset
-      if opt['op'] in stepOpts:
-        stepOpt = stepOpts[opt['op']]
-        convertValues(int, opt, stepOpt.get('toInt', []))
-        convertValues(float, opt, stepOpt.get('toFloat', []))
-        convertValues(lambda obj: obj.get('enable', 0), opt, stepOpt.get('isEnabled', []))
-        if 'getOpt' in stepOpt:
-          opt['opt'] = stepOpt['getOpt'].getOpt(opt)
-    if steps[-1]['op'] != 'output':
-      steps.append(dict(op='output'))
-    config.getFreeMem(True)
+    prepared or prepareSteps(steps)
     process = lambda im, name=None: last(rf(im), name, context)
   else:
     process = rf
   for i, opt in enumerate(steps):
     op = opt['op']
+    if op == 'output':
+      outputAt = (len(funcs), len(nodes))
     fs, ns, outType = procs[op](opt, outType, nodes)
     funcs.extend(fs)
     nodes.extend(ns)
@@ -196,7 +206,122 @@ def genProcess(steps, root=True, outType=None):
   if root and steps[0]['op'] == 'file':
     n = Node({'op': 'write'}, outType['load'])
     nodes.append(n)
-    last = n.bindFunc(writeFile)
+    last = n.bindFunc(writeBehind(writeFile) if steps[-1].get('writeBehind') else writeFile)
+    if batch:
+      i, j = outputAt
+      process = processStack(funcs[2], funcs[3:i], funcs[i:], nodes, nodes[1:j], last)
+    elif previewFormat:
+      preview = TilePreview(timeStage('preview', writePreview), config.previewInterval)
+      for opt in steps:
+        if isinstance(opt.get('opt'), Option):
+          opt['opt'].preview = preview
   else:
     context.imageMode = 'RGB'
-  return process, nodes
\ No newline at end of file
+  return process, nodes
+def processStack(toTorch, fs, fsOut, nodes, stacked, last):
+  """
+  Process (image, name, state) of images in the same shape, the ops between input and output run once on the stack of them;
+  `state` holds the image mode read with each image.
+  """
+  def f(images):
+    image, _, state = images[0]
+    for n in stacked:
+      n.multipleLoad(len(images))
+    setLoad(nodes, image, state.imageMode)
+    x = reduce(apply, fs, stack(toTorch)([im for im, *_ in images]))
+    return [last(reduce(apply, fsOut, t), name, state) for t, (_, name, state) in zip(x, images)]
+  return f
+
+ramRatios = (1., .5, .25) # memory shares of the tile plans tried for each stack size
+
+def planOp(node, opt, shape, freeMem, load):
+  """
+  (predicted seconds, memory share) of the cheapest tile plan of an op on a stack of `shape`;
+  None without a trusted model, raises MemoryError if no plan fits.
+  """
+  if not isinstance(opt, Option):
+    t = predictCost(ops[node.op], load)
+    return None if t is None else (t, 1.)
+  best = None
+  for ratio in ramRatios:
+    try:
+      tiles = countTiles(opt, shape, freeMem * ratio)
+    except MemoryError:
+      break
+    t = predictCost(ops[node.op], load, tiles)
+    if t is None:
+      return None
+    if best is None or t < best[0]:
+      best = (t, ratio)
+  if best is None:
+    raise MemoryError('No tile plan fits for shape {}'.format(shape))
+  return best
+
+def pickStack(steps, image, count, limit):
+  """
+  Pick the stack size for `count` images like `image` up to `limit` and the tile plan of each stacked op,
+  with the least predicted time per image by the cost models; `steps` are prepared and their options get the plans.
+  Keeps `limit` and the default plans if any stacked op has no trusted model yet.
+  """
+  limit = min(count, limit)
+  opts = {step['name']: step.get('opt') for step in steps if not step['op'] in ('file', 'output')}
+  for opt in opts.values():
+    if isinstance(opt, Option): # plans are made for the shape of this group
+      opt.iterClip, opt.outShape, opt.ramRatio = None, None, 1.
+  if limit < 2:
+    return limit
+  try:
+    _, nodes = genProcess(steps, batch=True, prepared=True)
+    stacked = [node for node in nodes if getattr(node, 'name', None) in opts]
+    h, w, c = image.shape
+    freeMem = config.calcFreeMem()
+  except Exception:
+    return limit
+  best, bestCost, bestRatios = limit, None, {}
+  for n in sorted({1 << k for k in range(limit.bit_length())} | {limit}):
+    cost, ratios = 0, {}
+    for node in stacked:
+      try:
+        plan = planOp(node, opts[node.name], (n, c, h, w), freeMem, node.load * image.size * n)
+      except MemoryError:
+        cost = None
+        break
+      if plan is None:
+        return limit
+      cost += plan[0]
+      ratios[node.name] = plan[1]
+    if cost is not None and (bestCost is None or cost / n < bestCost):
+      best, bestCost, bestRatios = n, cost / n, ratios
+  for name, ratio in bestRatios.items():
+    if isinstance(opts[name], Option):
+      opts[name].ramRatio = ratio
+  return best
+
+def readState(file, name):
+  """Read an image with its own mode state, so images can be read in parallel; None if failed."""
+  state = SimpleNamespace(palette=None)
+  try:
+    return readImage(context.getFile(file), state), name, state
+  except Exception:
+    log.exception('read {} failed'.format(name))
+
+def processBatch(steps, files, names, start, pixels, map=map):
+  """
+  Read all images by `map`, then process those in the same shape as stacks of at most `pixels` pixels;
+  `start(nodes)` begins the progress of a stack. Returns names of the images failed to read.
+  """
+  groups = {}
+  failed = []
+  for item, name in zip(map(readState, files, names), names):
+    if item:
+      groups.setdefault(item[0].shape, []).append(item)
+    else:
+      failed.append(name)
+  steps = prepareSteps(deepcopy(steps)) # options are built once and shared by all stacks
+  for (h, w, _), images in groups.items():
+    size = pickStack(steps, images[0][0], len(images), max(1, pixels // (h * w)))
+    for i in range(0, len(images), size):
+      process, nodes = genProcess(steps, batch=True, prepared=True)
+      start(nodes)
+      process(images[i:i + size])
+  return failed
\ No newline at end of file
@@ -0,0 +1,79 @@
+"""
+Run a job under torch.profiler when `profile` is set in its diagnose option,
+the Chrome trace and the time of each progress node are written into config.profilePath.
+`profile` is true or a dict of the schedule (wait, warmup, active, repeat) and flags (shapes, memory);
+videos are profiled by the schedule over output frames, images as a whole.
+"""
+# pylint: disable=E1101
+import os
+import json
+import time
+import logging
+from torch.profiler import profile, schedule, ProfilerActivity, record_function
+from config import config
+import progress
+from worker import context
+
+log = logging.getLogger('Moe')
+defaultSchedule = dict(wait=1, warmup=1, active=3, repeat=1)
+nodePrefix = 'Node '
+deviceTime = lambda event: getattr(event, 'device_time_total', getattr(event, 'cuda_time_total', 0))
+deviceMemory = lambda event: getattr(event, 'device_memory_usage', getattr(event, 'cuda_memory_usage', 0))
+nodeScope = lambda label: record_function(nodePrefix + label)
+
+def getActivities():
+  return [ProfilerActivity.CPU, ProfilerActivity.CUDA] if config.cuda else [ProfilerActivity.CPU]
+
+def getSchedule(opt):
+  o = dict(defaultSchedule)
+  if type(opt) is dict:
+    o.update((k, int(opt[k])) for k in defaultSchedule if k in opt)
+  return schedule(**o)
+
+def nodeTimes(prof):
+  """Milliseconds and memory of each progress node recorded, slowest first."""
+  items = [dict(node=e.key[len(nodePrefix):], count=e.count,
+    cpu=e.cpu_time_total / 1e3, device=deviceTime(e) / 1e3,
+    cpuMemory=e.cpu_memory_usage, deviceMemory=deviceMemory(e))
+    for e in prof.key_averages() if e.key.startswith(nodePrefix)]
+  items.sort(key=lambda item: item['cpu'] + item['device'], reverse=True)
+  return items
+
+def exporter(base):
+  def f(prof):
+    name = '{}-{}'.format(base, prof.step_num)
+    path = os.path.join(config.profilePath, name)
+    try:
+      prof.export_chrome_trace(path + '.trace.json')
+      with open(path + '.nodes.json', 'w', encoding='utf-8') as fp:
+        json.dump(nodeTimes(prof), fp, ensure_ascii=False, indent=1)
+    except Exception:
+      log.exception('exporting profile {} failed'.format(name))
+      return
+    log.info('profile written to {}'.format(path))
+    context.notifier.send({'profile': [name + '.trace.json', name + '.nodes.json']})
+  return f
+
+def profiled(f, diagnose, name, stepped=False):
+  """`f` under the profiler if the diagnose option asks, `stepped` takes a profiler step each output frame."""
+  opt = diagnose.get('profile') if type(diagnose) is dict else None
+  if not opt:
+    return f
+  flags = opt if type(opt) is dict else {}
+  def g(*args, **kwargs):
+    os.makedirs(config.profilePath, exist_ok=True)
+    export = exporter('{}-{}'.format(name, int(time.time())))
+    with profile(activities=getActivities(), schedule=getSchedule(opt) if stepped else None,
+      on_trace_ready=export if stepped else None,
+      record_shapes=bool(flags.get('shapes')), profile_memory=bool(flags.get('memory'))) as prof:
+      context.profiler = prof if stepped else None
+      progress.profileScope = nodeScope
+      try:
+        res = f(*args, **kwargs)
+      finally:
+        progress.profileScope = None
+        context.profiler = None
+    if not stepped:
+      export(prof)
+    return res
+  return g
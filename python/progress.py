@@ -1,12 +1,77 @@
+import os
 import time
 import json
+import logging
+import threading
+from contextlib import contextmanager
 from os.path import exists
-from gevent import spawn, sleep
+from gevent import sleep
 
 ops = {}
 loadedOps = {}
 needSave = False
+dirtyOps = set() # keys of ops learned since last save
 noNotify = { 'toFloat', 'toOutput', 'Channel', 'toBuffer', 'toTorch' }
+counters = {'tiles': 0} # tiles cropped by doCrop so far
+device = '0' # run type of config, cost models are fitted for each
+costSamples = 1000 # samples a cost model keeps learning from
+minCostSamples = 8 # samples before a cost model is trusted
+
+class CostModel():
+  """
+  Time of one progress step of an op as a linear function of the features
+  (megapixels of load, tiles cropped, 1 for the call overhead), fitted by recursive least squares with forgetting;
+  batch size is priced by the load and tiles of one call.
+  """
+  def __init__(self, coef=None, P=None, samples=0, tileRate=0.):
+    self.coef = coef or [0., 0., 0.]
+    self.P = P or [[1e4 if i == j else 0. for j in range(3)] for i in range(3)]
+    self.samples = samples
+    self.tileRate = tileRate # average tiles per megapixel
+
+  def predict(self, x):
+    return sum(c * v for c, v in zip(self.coef, x))
+
+  def fit(self, x, y, forget=.98):
+    Px = [sum(p * v for p, v in zip(row, x)) for row in self.P]
+    g = [v / (forget + sum(a * b for a, b in zip(x, Px))) for v in Px]
+    e = y - self.predict(x)
+    self.coef = [c + k * e for c, k in zip(self.coef, g)]
+    self.P = [[(self.P[i][j] - g[i] * Px[j]) / forget for j in range(3)] for i in range(3)]
+    self.samples += 1
+    if x[0] > 0:
+      self.tileRate += (x[1] / x[0] - self.tileRate) / min(self.samples, 32)
+
+  def serialize(self):
+    return dict(coef=self.coef, P=self.P, samples=self.samples, tileRate=self.tileRate)
+
+def addTiles(n=1):
+  counters['tiles'] += n
+
+def setDevice(runType):
+  global device
+  device = str(runType)
+
+def costModel(op):
+  """The trusted cost model of the op on current device, or None."""
+  model = op.models.get(device)
+  return model if model and model.samples >= minCostSamples else None
+
+def predictCost(op, load, tiles=None):
+  """Predicted seconds of one progress step with `load`, tiles estimated by the load if not given; None if no trusted model."""
+  model = costModel(op)
+  if model is None:
+    return None
+  mp = load * 1e-6
+  t = model.predict((mp, model.tileRate * mp if tiles is None else tiles, 1))
+  return t if t > 0 else None
+
+fitsCost = lambda node: node.fitCost and not len(node.nodes) # only leaf ops run models, parents sum their children
+
+def nodeCost(node):
+  op = ops[node.op]
+  t = predictCost(op, node.load, node.tiles) if fitsCost(node) else None
+  return op.weight * node.load if t is None else t
 
 def recurse(f):
   def r(node):
@@ -14,60 +79,203 @@ def recurse(f):
     for n in node.nodes:
       r(n)
   return r
-getNodeETA = lambda node: ops[node.op].weight * node.load * max(0, node.total - node.gone)
-sumETT = lambda node: sum(map(lambda n: n.ett, node.nodes)) if len(node.nodes) else 1
-getETT = lambda node: ops[node.op].weight * node.load * max(0, node.total) * sumETT(node)
+getNodeETA = lambda node: nodeCost(node) * max(0, node.total - node.gone)
+sumETT = lambda node: childSums(node).childETT if len(node.nodes) else 1
+getETT = lambda node: nodeCost(node) * max(0, node.total) * sumETT(node)
+
+def childSums(node):
+  """
+  Children ETT of a node are kept in a Fenwick tree for prefix sums in O(log n),
+  rebuilt with child indices after the children change.
+  """
+  if node.sums is None:
+    n = len(node.nodes)
+    sums = [0] * (n + 1)
+    for i, child in enumerate(node.nodes, 1):
+      child.index = i - 1
+      sums[i] += child.ett
+      j = i + (i & -i)
+      if j <= n:
+        sums[j] += sums[i]
+    node.sums = sums
+    node.childETT = sum(child.ett for child in node.nodes)
+  return node
+
+def prefixETT(node, i):
+  """Sum of ETT of the children up to the i-th inclusive."""
+  sums = childSums(node).sums
+  s = 0
+  i += 1
+  while i > 0:
+    s += sums[i]
+    i -= i & -i
+  return s
+
+def setETT(node, ett):
+  delta = ett - node.ett
+  node.ett = ett
+  p = node.parent
+  if p is None or p.sums is None or not delta:
+    return
+  p.childETT += delta
+  sums = p.sums
+  i = node.index + 1
+  while i < len(sums):
+    sums[i] += delta
+    i += i & -i
+
 def updateNode(node):
-  s = ops[node.op].weight * node.load * sumETT(node)
+  s = nodeCost(node) * sumETT(node)
   if node.total >= 0:
-    node.ett = node.total * s
+    setETT(node, node.total * s)
     node.eta = (node.total - node.gone) * s
   else:
-    node.ett = node.eta = -1
+    setETT(node, -1)
+    node.eta = -1
 slideAverage = lambda coef: lambda op, sample: coef * op.weight + (1 - coef) * sample
 setNodeCallback = lambda node, callback, any, bench: node.setCallback(callback, bench) if any or hasattr(node, 'name') else None
 setCallback = lambda node, callback, all=False, bench=False: recurse(lambda node: setNodeCallback(node, callback, all, bench))(node)
 getOpKey = lambda op: hash(frozenset(op.items()))
 NullFunc = lambda *args: None
-loadOps = lambda path: spawn(loadInternal, path).start()
-serializeOp = lambda op: dict(op=op.op, weight=op.weight, samples=op.samples)
-serializeOps = lambda: [serializeOp(ops[key]) for key in ops]
+timing = None # synchronizes devices before reading the clock while stage timing is on
+stageTimes = {} # seconds spent in each stage since timing started
+profileScope = None # label -> context manager marking a node call in the profiler, while profiling
+opLabel = lambda op: ' '.join('{}={}'.format(k, v) for k, v in op.items())
+
+def timeStage(stage, f):
+  """Wrap `f` to add its running time to `stage` while timing is on."""
+  def g(*args, **kwargs):
+    if timing is None:
+      return f(*args, **kwargs)
+    timing()
+    start = time.perf_counter()
+    try:
+      return f(*args, **kwargs)
+    finally:
+      timing()
+      stageTimes[stage] = stageTimes.get(stage, 0) + time.perf_counter() - start
+  return g
+
+def startTiming(sync=NullFunc):
+  global timing
+  stageTimes.clear()
+  timing = sync
+
+def stopTiming():
+  """Stop stage timing and return the seconds of each stage."""
+  global timing
+  timing = None
+  return dict(stageTimes)
+serializeOp = lambda op: dict(op=op.op, weight=op.weight, samples=op.samples,
+  models={k: model.serialize() for k, model in op.models.items()})
+serializeOps = lambda: [serializeOp(op) for op in list(ops.values())]
+
+@contextmanager
+def fileLock(path, stale=10):
+  """Exclusive lock between processes by creating `path`, a lock older than `stale` seconds is taken as left by a dead process."""
+  while True:
+    try:
+      fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+      break
+    except FileExistsError:
+      try:
+        if time.time() - os.path.getmtime(path) > stale:
+          os.remove(path)
+      except OSError:
+        pass
+      time.sleep(.05)
+  try:
+    yield
+  finally:
+    os.close(fd)
+    os.remove(path)
+
+def readOps(path):
+  if not exists(path):
+    return []
+  try:
+    with open(path, 'r', encoding='utf-8') as fp:
+      return json.load(fp)
+  except ValueError as e:
+    logging.warning('ignored broken {}: {}'.format(path, e))
+    return []
 
 def saveInternal(path):
-  with open(path, 'w') as fp:
-    json.dump(serializeOps(), fp, ensure_ascii=False, indent=2)
+  """
+  Merge ops learned in this process into the file, keeping those saved by other processes,
+  then replace the file atomically; runs under a lock file shared with other workers.
+  """
+  keys = list(dirtyOps)
+  dirtyOps.difference_update(keys)
+  try:
+    with fileLock(path + '.lock'):
+      entries = {getOpKey(item['op']): item for item in readOps(path)}
+      entries.update((key, serializeOp(ops[key])) for key in keys if key in ops)
+      tmp = '{}.{}.tmp'.format(path, os.getpid())
+      with open(tmp, 'w', encoding='utf-8') as fp:
+        json.dump(list(entries.values()), fp, ensure_ascii=False, indent=2)
+        fp.flush()
+        os.fsync(fp.fileno())
+      os.replace(tmp, path)
+  except Exception:
+    dirtyOps.update(keys) # retry with the next save
+    raise
+
+class OpsWriter():
+  """Writes ops on a background thread off the inference thread, save requests within `delay` seconds are written once."""
+  def __init__(self, delay=2.):
+    self.delay = delay
+    self.path = None
+    self.event = threading.Event()
+    self.thread = None
+
+  def request(self, path):
+    self.path = path
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.run, name='opsWriter', daemon=True)
+      self.thread.start()
+    self.event.set()
+
+  def run(self):
+    while True:
+      self.event.wait()
+      time.sleep(self.delay)
+      self.event.clear()
+      try:
+        saveInternal(self.path)
+      except Exception as e:
+        logging.warning('saving ops failed: {}'.format(e))
+
+opsWriter = OpsWriter()
 
 def saveOps(path=None, force=False):
   global needSave
   if path and (needSave or force):
-    spawn(saveInternal, path).start()
+    opsWriter.request(path)
     needSave = False
-  return serializeOps()
 
 def loadInternal(path):
-  if not exists(path):
-    return
-  with open(path, 'r') as fp:
-    res = json.load(fp)
-  for op in res:
-    loadedOps[getOpKey(op['op'])] = (op['weight'], op['samples'])
+  for op in readOps(path):
+    loadedOps[getOpKey(op['op'])] = (op['weight'], op['samples'], op.get('models', {}))
+loadOps = loadInternal
 
 def initOp(op, learn=True):
   op.weight = 1e-6 if learn else 1
   op.samples = 0
+  op.models = {}
 
 def clearOps(node, flag=True):
   if flag:
     loadedOps.clear()
-    recurse(lambda n: initOp(ops[n.op], n.learn))(node)
+    recurse(lambda n: initOp(ops[n.op], n.learn) or dirtyOps.add(n.op))(node)
 
 def newOp(learn, define={}, updater=slideAverage(.9)):
   def op():pass
   key = getOpKey(define)
   op.op = define
   if key in loadedOps:
-    op.weight = loadedOps[key][0]
-    op.samples = loadedOps[key][1]
+    op.weight, op.samples, models = loadedOps[key]
+    op.models = {k: CostModel(**v) for k, v in models.items()}
   else:
     initOp(op, learn)
   def f(sample):
@@ -76,16 +284,16 @@ def newOp(learn, define={}, updater=slideAverage(.9)):
       needSave = True
     op.samples += 1
     op.weight = updater(op, sample) if op.samples > 2 else sample
+    dirtyOps.add(key)
   op.update = f
   return op
 
 def updateAncestor(node, eta=False):
   p = node.parent
   while p:
-    i = p.nodes.index(node)
     updateNode(p)
     if eta and p.total >= 0:
-      p.eta += node.eta - sum(map(lambda n: n.ett, p.nodes[:i + 1]))
+      p.eta += node.eta - prefixETT(p, node.index)
       if p.eta < 0:
         p.eta = p.ett * (p.total - p.gone) / p.total
     node = p
@@ -96,7 +304,7 @@ def initialETA(node):
   s = sum(map(initialETA, node.nodes)) if len(node.nodes) else 1
   c = getNodeETA(node)
   node.eta = c * s if node.total >= 0 else -1
-  node.ett = node.eta
+  setETT(node, node.eta)
   return node.ett
 
 class Node():
@@ -107,7 +315,13 @@ class Node():
     self.ett = 0
     self.eta = 0
     self.mark = 0
+    self.markTiles = 0
+    self.tiles = None # tiles cropped in a progress step last time
+    self.fitCost = bool(learn)
     self.parent = None
+    self.index = 0 # in the children of parent
+    self.sums = None # Fenwick tree of children ETT, None till needed
+    self.childETT = 0
     self.bench = False
     self.learn = learn or 0
     self.callback = callback
@@ -122,6 +336,7 @@ class Node():
   def append(self, child):
     self.nodes.append(child)
     child.parent = self
+    self.sums = None
     return self
 
   def setCallback(self, callback=NullFunc, bench=False):
@@ -139,7 +354,7 @@ class Node():
 
   def reset(self):
     self.gone = 0
-    self.ett = getETT(self)
+    setETT(self, getETT(self))
     self.eta = self.ett
     return self
 
@@ -147,18 +362,32 @@ class Node():
     global needSave
     self.gone += progress
     op = ops[self.op]
-    if self.learn > op.samples:
+    learnWeight = self.learn > op.samples
+    fitCost = fitsCost(self)
+    model = op.models.get(device) if fitCost else None
+    if fitCost and model is None:
+      model = op.models[device] = CostModel()
+    learnCost = model is not None and model.samples < costSamples
+    if learnWeight or learnCost:
       mark = time.perf_counter()
+      tiles = counters['tiles']
       if progress > 0:
         delta = mark - self.mark
-        if self.load > 0:
-          op.update(delta / self.load / progress)
-        if op.samples >= self.learn:
-          self.learn = False
-          needSave = True
+        self.tiles = (tiles - self.markTiles) / progress
+        if learnWeight:
+          if self.load > 0:
+            op.update(delta / self.load / progress)
+          if op.samples >= self.learn:
+            self.learn = False
+            needSave = True
+        if learnCost and self.load > 0:
+          model.fit((self.load * 1e-6, self.tiles, 1), delta / progress)
+          dirtyOps.add(self.op)
+          needSave |= not model.samples & 15
         if self.bench:
           kwargs.update(serializeOp(op))
       self.mark = mark
+      self.markTiles = tiles
     if progress > 0:
       updateNode(self)
       updateAncestor(self, True)
@@ -170,7 +399,11 @@ class Node():
       if self.bench:
         sleep(.1) # leave time handling client connection
       self.trace(0)
-      res = f(*args, **kwargs)
+      if profileScope is None:
+        res = f(*args, **kwargs)
+      else:
+        with profileScope(opLabel(ops[self.op].op)):
+          res = f(*args, **kwargs)
       self.trace()
       return res
     return g
@@ -185,6 +418,7 @@ class Node():
   def remove(self, update=False):
     self.parent.nodes.remove(self)
     p = self.parent
+    p.sums = None
     self.parent = None
     if update:
       updateNode(p)
@@ -198,6 +432,7 @@ class Node():
       target.append(self)
     else:
       target.nodes.insert(pos, self)
+      target.sums = None
       self.parent = target
     if flag:
       updateAncestor(self)
@@ -0,0 +1,102 @@
+import os
+import time
+import sqlite3
+
+Null = lambda *_: None
+
+schema = '''
+create table if not exists results (
+  id integer primary key,
+  key text not null,
+  session text not null,
+  path text not null,
+  body text not null,
+  code integer not null,
+  finished real not null,
+  delivered integer not null default 0
+);
+create index if not exists resultsKey on results (key, delivered);
+create index if not exists resultsSession on results (session, finished);
+create index if not exists resultsFinished on results (finished);
+'''
+columns = ('id', 'session', 'path', 'body', 'code', 'finished', 'delivered')
+toRow = lambda row: dict(zip(columns, row))
+
+class ResultStore():
+  """
+  Latest message of each key for watchers, progress notes are kept in memory
+  and job results in a SQLite database in WAL mode, so they outlive the server;
+  results are kept for `ttl` seconds and at most `size` of them.
+  """
+  def __init__(self, path, ttl, size, default=None, onExtinct=Null):
+    self.notes = {}
+    self.ttl = ttl
+    self.size = size
+    self.default = default
+    self.extinct = onExtinct
+    if path != ':memory:':
+      os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    self.db.execute('pragma journal_mode=wal')
+    self.db.execute('pragma synchronous=normal')
+    self.db.executescript(schema)
+    self.expire()
+
+  def put(self, key, item):
+    self.notes[key] = item
+
+  def update(self, key, item):
+    old = self.notes.get(key)
+    if type(old) is dict and type(item) is dict:
+      old.update(item)
+    else:
+      self.notes[key] = item
+
+  def pending(self, key):
+    return self.db.execute('select id, body, code from results where key = ? and delivered = 0 order by id desc limit 1', (key,)).fetchone()
+
+  def peek(self, key):
+    return key in self.notes or self.pending(key) is not None
+
+  def pop(self, key):
+    """The latest note, or the undelivered result of the key, which is marked delivered then."""
+    if key in self.notes:
+      return self.notes.pop(key)
+    row = self.pending(key)
+    if row is None:
+      return self.default
+    self.db.execute('update results set delivered = 1 where key = ?', (key,))
+    return row[1], row[2]
+
+  def finish(self, job, res):
+    """Store the (body, code) result of a job in place of its notes."""
+    self.notes.pop(job.key, None)
+    self.db.execute('insert or replace into results (id, key, session, path, body, code, finished) values (?, ?, ?, ?, ?, ?, ?)',
+      (job.id, job.key, str(job.session), job.path, res[0], res[1], time.time()))
+    self.expire()
+
+  def get(self, jobId):
+    row = self.db.execute('select {} from results where id = ?'.format(', '.join(columns)), (jobId,)).fetchone()
+    return toRow(row) if row else None
+
+  def list(self, session=None, offset=0, limit=20):
+    """Results newest first, of a session if given, and the total count."""
+    where, args = ('where session = ?', (str(session),)) if session else ('', ())
+    total = self.db.execute('select count(*) from results ' + where, args).fetchone()[0]
+    rows = self.db.execute('select {} from results {} order by finished desc limit ? offset ?'.format(', '.join(columns), where),
+      args + (limit, offset)).fetchall()
+    return [toRow(row) for row in rows], total
+
+  def lastId(self):
+    return self.db.execute('select max(id) from results').fetchone()[0] or 0
+
+  def expire(self):
+    deadline = time.time() - self.ttl
+    rows = self.db.execute('''select id, key from results where finished < ? or id not in
+      (select id from results order by finished desc limit ?)''', (deadline, self.size)).fetchall()
+    self.db.executemany('delete from results where id = ?', [row[:1] for row in rows])
+    for row in rows:
+      self.extinct(*row)
+
+  def close(self):
+    self.db.close()
@@ -0,0 +1,232 @@
+import os
+import json
+import heapq
+import logging
+from io import BytesIO
+from itertools import count
+from gevent import spawn
+from gevent.event import AsyncResult
+from sharedMemory import Segments
+from ipc import waitReadable, receive
+
+Null = lambda *_: None
+jobIds = count(1)
+
+class Worker():
+  """Server side handle of a worker process, with its own task pipes and job queue."""
+  def __init__(self, index, device, sender, receiver, noter, stopEvent):
+    self.index = index
+    self.device = device
+    self.sender = sender
+    self.receiver = receiver
+    self.noter = noter
+    self.stopFlag = stopEvent
+    self.outputs = Segments() # slots written by the worker
+    self.job = None
+    self.queue = [] # heap of (-priority, order, job)
+    self.models = set() # models loaded by jobs ran on this worker
+
+  def depth(self):
+    return len(self.queue) + (self.job is not None)
+
+  def state(self):
+    return dict(index=self.index, device=self.device, job=self.job.id if self.job else None,
+      queue=len(self.queue), models=sorted(self.models))
+
+  def getPreview(self, slot):
+    view = self.outputs.view(slot)
+    res = BytesIO(view)
+    view.release()
+    return res
+
+  def send(self, *task):
+    self.sender.send(task)
+
+  def receive(self):
+    return receive(self.receiver)
+
+  def call(self, *task):
+    self.send(*task)
+    return self.receive()
+
+  def drainNotes(self):
+    while self.noter.poll():
+      self.noter.recv()
+
+class Job():
+  """
+  A queued or running task of a session.
+  `run(worker)` is called once a worker is assigned and returns the (result, code) tuple;
+  `task` is the serializable form of the job for restoring it after restarts, None if it can't be restored.
+  """
+  def __init__(self, session, path, run, priority=0, task=None, id=None, models=()):
+    self.id = id or next(jobIds)
+    self.session = session
+    self.path = path
+    self.key = path + str(session)
+    self.run = run
+    self.priority = priority
+    self.task = task
+    self.models = set(models)
+    self.result = AsyncResult()
+    self.worker = None
+    self.stopped = False
+    self.eta = 1
+    self.setETA = True
+    self.preview = None # slot of the latest preview
+    self.seq = 0
+    self.notes = {} # key -> (seq, value) of the latest note values
+    self.updated = AsyncResult()
+
+  def state(self):
+    return 'running' if self.worker else 'queued'
+
+  def publish(self, note):
+    self.seq += 1
+    for k, v in note.items():
+      self.notes[k] = (self.seq, v)
+    updated, self.updated = self.updated, AsyncResult()
+    updated.set(self.seq)
+
+  def changes(self, seq, timeout=None):
+    """Merged note values published after `seq`, waits for new ones if there is none."""
+    if seq >= self.seq and not self.result.ready():
+      self.updated.wait(timeout)
+    return self.seq, {k: v for k, (s, v) in self.notes.items() if s > seq}
+
+  def serialize(self):
+    return dict(id=self.id, session=self.session, path=self.path, priority=self.priority, task=self.task,
+      models=sorted(self.models))
+
+class Scheduler():
+  """
+  Routes jobs to worker queues by model affinity and queue depth, idle workers take jobs from the longest queue;
+  queued jobs are kept on disk across restarts.
+  """
+  def __init__(self, workers, path=None, onNote=Null, onFinish=lambda _, result: result):
+    self.workers = workers
+    self.path = path
+    self.onNote = onNote
+    self.onFinish = onFinish
+    self.jobs = {} # key -> queued or running job
+    self.order = count()
+    for worker in workers:
+      spawn(self.pumpNotes, worker)
+
+  def route(self, job):
+    # loading a missing model costs about as much as waiting for a job
+    return min(self.workers, key=lambda w: (w.depth() + len(job.models - w.models), w.index))
+
+  def submit(self, job):
+    self.jobs[job.key] = job
+    heapq.heappush(self.route(job).queue, (-job.priority, next(self.order), job))
+    self.save()
+    self.dispatch()
+    return job
+
+  def position(self, job):
+    for worker in self.workers:
+      rank = next((item[:2] for item in worker.queue if item[2] is job), None)
+      if rank:
+        return (worker.job is not None) + sum(1 for item in worker.queue if item[:2] < rank and not item[2].stopped)
+    return -1
+
+  def find(self, session):
+    return next((job for job in self.jobs.values() if job.session == session), None)
+
+  def byId(self, jobId):
+    return next((job for job in self.jobs.values() if job.id == jobId), None)
+
+  def take(self, worker):
+    others = sorted((w.queue for w in self.workers if w is not worker), key=len, reverse=True)
+    for queue in [worker.queue] + others:
+      while len(queue):
+        job = heapq.heappop(queue)[2]
+        if not job.stopped:
+          return job
+
+  def dispatch(self):
+    for worker in self.workers:
+      job = None if worker.job else self.take(worker)
+      if job:
+        worker.job = job
+        job.worker = worker
+        spawn(self.execute, worker, job)
+
+  def execute(self, worker, job):
+    worker.drainNotes()
+    worker.stopFlag.clear()
+    result = ({'result': 'Fail'}, 400)
+    try:
+      result = job.run(worker)
+    except Exception as e:
+      logging.exception(e)
+      result = ({'result': 'Fail', 'exception': str(e)}, 400)
+    finally:
+      self.readNotes(worker, job)
+      worker.models |= job.models
+      worker.outputs.clear()
+      worker.job = None
+      self.finish(job, result)
+      self.dispatch()
+
+  def readNotes(self, worker, job):
+    while worker.noter.poll():
+      note = worker.noter.recv()
+      job and self.onNote(job, note)
+
+  def pumpNotes(self, worker):
+    while True:
+      waitReadable(worker.noter)
+      self.readNotes(worker, worker.job)
+
+  def finish(self, job, result):
+    if self.jobs.get(job.key) is job:
+      del self.jobs[job.key]
+    self.save()
+    job.result.set(self.onFinish(job, result))
+    job.publish({})
+
+  def cancel(self, job):
+    job.stopped = True
+    if job.worker:
+      job.worker.stopFlag.set()
+    else:
+      self.finish(job, ({'result': 'Interrupted'}, 200))
+
+  def save(self):
+    if not self.path:
+      return
+    jobs = [job.serialize() for job in self.jobs.values()]
+    tmp = self.path + '.tmp'
+    try:
+      with open(tmp, 'w', encoding='utf-8') as fp:
+        json.dump(jobs, fp, ensure_ascii=False)
+      os.replace(tmp, self.path)
+    except Exception as e:
+      logging.warning(e)
+
+  def load(self, makeRun, lastId=0):
+    """
+    Requeue jobs left by last run, `makeRun(task)` recreates the run function of a job;
+    jobs without task are finished as interrupted. New job IDs start after `lastId` and the loaded ones.
+    """
+    global jobIds
+    jobIds = count(lastId + 1)
+    if not (self.path and os.path.exists(self.path)):
+      return []
+    try:
+      with open(self.path, 'r', encoding='utf-8') as fp:
+        items = json.load(fp)
+    except Exception as e:
+      logging.warning(e)
+      return []
+    jobIds = count(max([lastId] + [item['id'] for item in items]) + 1)
+    jobs = [Job(item['session'], item['path'], item['task'] and makeRun(item['task']), item['priority'], item['task'], item['id'], item.get('models', ())) for item in items]
+    for job in jobs:
+      if job.task:
+        logging.info('restore job #{} of session {}'.format(job.id, job.session))
+        self.submit(job)
+      else:
+        self.finish(job, ({'result': 'Interrupted'}, 200))
+    return jobs
@@ -5,11 +5,17 @@ import json
 import codecs
 import re
 import psutil
-from io import BytesIO
-from flask import Flask, render_template, request, jsonify, send_from_directory, make_response, Response, send_file
-from gevent import pywsgi, idle, spawn
+import atexit
+import tempfile
+from collections import deque
+from itertools import islice
+from flask import Flask, Request, render_template, request, jsonify, send_from_directory, make_response, Response, send_file
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Epilogue, Field, File, Data
+from gevent import pywsgi, idle, spawn, sleep
 from userConfig import setConfig, VERSION
-from FIFOcache import Cache
+from resultStore import ResultStore
+from scheduler import Scheduler, Worker, Job
+from sharedMemory import Arena, Slot, SlotFile
 from preset import preset, initPreset
 
 config = {}
@@ -20,26 +26,33 @@ try:
 except Exception as e:
   logging.warning(e)
 staticMaxAge = 86400
+class StreamRequest(Request):
+  """Uploaded images go straight into shared memory while the request body arrives."""
+  def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+    if self.path == '/image_enhance' and total_content_length:
+      return SlotFile(arena.alloc(total_content_length))
+    return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 app = Flask(__name__, root_path='.')
+app.request_class = StreamRequest
 app.config['SERVER_NAME'] = '.'
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = staticMaxAge
 startupTime = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
-def current():pass
-current.session = None
-current.path = None
-current.key = None
-current.eta = 0
-current.setETA = True
-current.fileSize = 0
 E403 = ('Not authorized.', 403)
 E404 = ('Not Found', 404)
 OK = ('', 200)
-cache = Cache(config['maxResultsKept'], OK, lambda *args: logging.info('abandoned', *args))
-busy = lambda: (jsonify(result='Busy', eta=current.eta), 503)
+pushInterval = .1
+keepAlive = 15
+cache = ResultStore(config['resultsPath'], config['resultTTL'], config['maxResultsKept'], OK,
+  lambda *args: logging.info('abandoned result {} of {}'.format(*args)))
+busy = lambda job: (jsonify(result='Busy', eta=job.eta), 503)
 cwd = os.getcwd()
 outDir = config['outDir']
 uploadDir = config['uploadDir']
+uploadFollow = config['uploadFollow']
+batchSize = config['batchSize']
 logPath = os.path.abspath(config['logPath'])
+profileDir = os.path.abspath(config['profilePath'])
 previewFormat = config['videoPreview']
 downDir = os.path.join(app.root_path, outDir)
 if not os.path.exists(outDir):
@@ -48,8 +61,9 @@ with open('static/manifest.json') as manifest:
   assetMapping = json.load(manifest)
 vendorsJs = assetMapping['vendors.js'] if 'vendors.js' in assetMapping else None
 commonJs = assetMapping['common.js'] if 'common.js' in assetMapping else None
-getKey = lambda session, request: request.values['path'] + str(session) if 'path' in request.values else current.key
+getKey = lambda session, request: request.values['path'] + str(session) if 'path' in request.values else getattr(scheduler.find(session), 'key', None)
 toResponse = lambda obj, code=200: obj if type(obj) is tuple else (json.dumps(obj, ensure_ascii=False, separators=(',', ':')), code)
+toBody = lambda body: body if type(body) is str else toResponse(body)[0]
 
 def tryFunc(f, *args):
   try:
@@ -57,45 +71,46 @@ def tryFunc(f, *args):
   except Exception:
     return None
 
-def updateNote(key, note):
+def updateNote(job, note):
   if note and len(note):
-    if current.setETA:
-      updateETA(note)
+    if job.setETA:
+      updateETA(job, note)
     else:
       note.pop('total', 0)
       note.pop('gone', 0)
       note.pop('eta', 0)
-    if 'fileSize' in note:
-      current.fileSize = note['fileSize']
-      del note['fileSize']
+    if 'slot' in note:
+      job.preview = note.pop('slot')
+      note['preview'] = previewPath.format(job.id)
     if len(note):
-      cache.update(key, note)
-
-def pollNote():
-  key = current.key
-  while current.key:
-    while current.key and not noter.poll():
-      idle()
-    while noter.poll():
-      updateNote(key, noter.recv())
-
-def acquireSession(request):
-  if current.session:
-    return busy()
-  current.session = -1
-  current.eta = 0.1
-  while noter.poll():
-    noter.recv()
-  current.session = request.values['session']
-  current.path = request.values['path'] if 'path' in request.values else request.path
-  current.key = current.path + str(current.session)
-  cache.put(current.key, {'eta': 60})
-  spawn(pollNote)
-  current.eta = 1
-  updateETA(request.values)
-  return False if current.session else E403
-
-def controlPoint(path, fMatch, fUnmatch, fNoCurrent, check=lambda *_: True):
+      notify(job, note)
+
+def notify(job, note, replace=False):
+  (cache.put if replace else cache.update)(job.key, note)
+  job.publish(note)
+
+modelKeys = lambda steps: ['{}:{}'.format(step['op'], step['model'])
+  for step in steps if type(step) is dict and 'op' in step and 'model' in step]
+
+runningJob = lambda values, path: scheduler.jobs.get(values.get('path', path) + str(values['session']))
+
+def newJob(values, path, run, task=None, models=()):
+  job = runningJob(values, path)
+  if job:
+    return busy(job)
+  job = Job(values['session'], values.get('path', path), run, int(values.get('priority', 0)), task, models=models)
+  updateETA(job, values)
+  notify(job, {'eta': 60, 'job': job.id}, True)
+  return job
+
+def submitJob(job):
+  scheduler.submit(job)
+  position = scheduler.position(job)
+  if position >= 0:
+    notify(job, {'eta': job.eta, 'job': job.id, 'queue': position}, True)
+  return job
+
+def controlPoint(path, fJob, fNoJob):
   def f():
     if not 'session' in request.values:
       return E403
@@ -103,60 +118,92 @@ def controlPoint(path, fMatch, fUnmatch, fNoCurrent, check=lambda *_: True):
     if not session:
       return E403
     key = getKey(session, request)
-    if current.session:
-      return spawn(fMatch, key).get() if current.session == session and check(request) else fUnmatch()
-    else:
-      return spawn(fNoCurrent, key).get()
+    job = scheduler.jobs.get(key) if key else None
+    return spawn(fJob, key, job).get() if job else spawn(fNoJob, key).get()
   app.route(path, methods=['GET', 'POST'], endpoint=path)(f)
 
-def stopCurrent(*_):
-  if current.session:
-    if hasattr(current, 'root'):
-      current.root.toStop() # pylint: disable=E1101
-    current.stopFlag.set()
+def stopJob(_, job):
+  scheduler.cancel(job)
   return OK
 
-def checkMsgMatch(request):
-  if not 'path' in request.values:
-    return True
-  path = request.values['path']
-  return path == current.path
-
-def updateETA(res):
+def updateETA(job, res):
   if 'eta' in res:
-    current.eta = res['eta']
-
-def onConnect(key):
-  while not (current.session is None or (key and cache.peek(key))):
-    idle()
-  res = None
-  if key and cache.peek(key):
-    res = cache.pop(key)
-    return toResponse(res)
+    job.eta = res['eta']
+
+def onConnect(key, job):
+  while not (job.result.ready() or cache.peek(key)):
+    job.updated.wait()
+  if cache.peek(key):
+    return toResponse(cache.pop(key))
   else:
     return OK
 
-def endSession(result):
-  cache.put(current.key, result)
-  current.key = None
-  current.session = None
-  return toResponse(result)
+def formatEvent(res):
+  if type(res) is tuple:
+    body, code = res[:2]
+    event = 'event: failure\n' if code >= 400 else ''
+  else:
+    body, event = res, ''
+  return '{}data: {}\n\n'.format(event, toBody(body).replace('\n', '\ndata: '))
+
+def eventStream(key, job):
+  """Push merged notes of a job to one watcher, at most one message per `pushInterval`."""
+  if job is None:
+    yield formatEvent(toResponse(spawn(onRequestCache, key).get()))
+    return
+  seq = 0
+  while not job.result.ready():
+    seq, note = job.changes(seq, keepAlive)
+    yield formatEvent(note) if len(note) else ': \n\n'
+    sleep(pushInterval)
+  if cache.peek(key):
+    cache.pop(key)
+  yield formatEvent(job.result.get())
+
+def onEvents():
+  session = request.values.get('session')
+  if not session:
+    return E403
+  key = getKey(session, request)
+  job = scheduler.jobs.get(key) if key else None
+  return Response(eventStream(key, job), mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def endJob(job, result):
+  for slot in getattr(job, 'slots', ()):
+    slot.free()
+  final = getattr(job, 'final', None)
+  res = toResponse(final(result) if final else toResponse(*result))
+  body, code = res[:2]
+  cache.finish(job, (toBody(body), code))
+  return res
 
-def makeHandler(name, prepare, final, methods=['POST']):
+makeRun = lambda task: lambda worker: worker.call(*task)
+
+def startJob(name, args, final, values, path, restorable=False):
+  slots = [arg for arg in args if isinstance(arg, Slot)]
+  task = (name, *(arg.desc if isinstance(arg, Slot) else arg for arg in args))
+  job = newJob(values, path, makeRun(task), task if restorable else None, modelKeys(args))
+  if type(job) is tuple:
+    for slot in slots:
+      slot.free()
+    return job
+  job.slots = slots
+  job.final = lambda result: final(result, values)
+  return submitJob(job)
+
+def makeHandler(name, prepare, final, methods=['POST'], restorable=False):
   def f():
-    c = acquireSession(request)
-    if c:
-      return c
+    if not request.values.get('session'):
+      return E403
     try:
       args = prepare(request)
     except Exception as e:
       res = (str(e), 400)
-      endSession(res)
+      cache.put(request.path + str(request.values['session']), res)
       return res
-    sender.send((name, *args))
-    while not receiver.poll():
-      idle()
-    return endSession(final(receiver.recv(), request))
+    job = startJob(name, args, final, request.values, request.path, restorable)
+    return job if type(job) is tuple else job.result.get()
   app.route('/' + name, methods=methods, endpoint=name)(f)
 
 def renderPage(item, header=None, footer=None):
@@ -196,15 +243,47 @@ def gallery(req):
   items = ()
   dirName = req.values['dir'] if 'dir' in req.values else outDir
   items = tryFunc(lambda s: os.listdir(s), dirName)
-  images = filter((lambda item:item.split('.')[-1] in {'png', 'jpg', 'jpeg', 'webp', 'bmp', 'gif'}), items)
+  images = [*filter((lambda item:item.split('.')[-1] in {'png', 'jpg', 'jpeg', 'webp', 'bmp', 'gif'}), items)]
+  offset, limit = getPage(req, len(images))
   doc = []
-  images = [*map(lambda image:ndoc.format(image=image, dirName=dirName), images)]
+  images = [*map(lambda image:ndoc.format(image=image, dirName=dirName), images[offset:offset + limit])]
   for i in range((len(images) - 1) // 3 + 1):
     doc.append('<div class="col-sm-4 col-xs-4 w3gallery-grids">')
     doc.extend(images[i * 3:(i + 1) * 3])
     doc.append('</div>')
   return (''.join(doc),) if len(doc) else ('暂时没有图片，快去尝试放大吧',)
 
+def intArg(req, key, default=0):
+  """A non-negative integer argument, `default` if it's missing or malformed."""
+  try:
+    return max(0, int(req.values.get(key, default)))
+  except ValueError:
+    return default
+
+def getPage(req, limit=20):
+  return intArg(req, 'offset'), intArg(req, 'limit', limit)
+
+def listResults():
+  session = request.values.get('session')
+  if not session:
+    return E403
+  rows, total = cache.list(session, *getPage(request))
+  return toResponse({'results': rows, 'total': total})
+
+def getResult(jobId):
+  row = cache.get(jobId)
+  if not row or row['session'] != request.values.get('session'):
+    return E404
+  return row['body'], row['code']
+
+def listProfiles():
+  """Profiles exported by diagnose jobs, newest first."""
+  names = tryFunc(os.listdir, profileDir) or []
+  items = [dict(name=name, size=os.path.getsize(os.path.join(profileDir, name)), time=os.path.getmtime(os.path.join(profileDir, name)))
+    for name in names if name.endswith('.json')]
+  items.sort(key=lambda item: item['time'], reverse=True)
+  return toResponse({'profiles': items})
+
 def getSystemInfo(info):
   import readgpu
   cuda, cudnn = readgpu.getCudaVersion()
@@ -224,17 +303,41 @@ def getSystemInfo(info):
   del readgpu
   return info
 
+gpuMemory = []
+def getGPUMemory():
+  """Free memory of each GPU in MB, read in this process so it's answered while workers run jobs."""
+  try:
+    if not gpuMemory:
+      import readgpu
+      if not readgpu.torch.cuda.is_available():
+        return []
+      readgpu.init()
+      gpuMemory.append(readgpu.getGPU)
+    return [freeMem // 2**20 for freeMem in gpuMemory[0]()]
+  except Exception as e:
+    logging.warning(e)
+    return []
+
+def systemInfo():
+  session = request.values.get('session')
+  if not session:
+    return E403
+  res = toResponse({'result': getGPUMemory()})
+  cache.put(request.path + str(session), res)
+  return res
+
 def getDynamicInfo(_):
   disk_free = tryFunc(lambda: psutil.disk_usage(cwd).total // 2**20)
   mem_free = tryFunc(lambda: psutil.virtual_memory().total // 2**20)
-  return disk_free, mem_free, current.session, current.path
+  jobs = [dict(id=job.id, session=job.session, path=job.path, state=job.state()) for job in scheduler.jobs.values()]
+  return disk_free, mem_free, jobs, [worker.state() for worker in scheduler.workers]
 
-def setOutputName(args, fp):
+def setOutputName(args, filename):
   if not len(args):
     args = ({'op': 'output'},)
   if 'file' in args[-1]:
     return args
-  base, ext = os.path.splitext(fp.filename)
+  base, ext = os.path.splitext(filename)
   path = '{}/{}{}'.format(outDir, base, ext)
   i = 0
   while os.path.exists(path):
@@ -243,11 +346,11 @@ def setOutputName(args, fp):
   args[-1]['file'] = path
   return args
 
-def responseEnhance(t, req):
+def responseEnhance(t, values):
   res, code = t
-  if 'eta' in req.values:
-    res['eta'] = float(req.values['eta'])
-  res.update((k, int(req.values[k])) for k in ('gone', 'total') if k in req.values)
+  if 'eta' in values:
+    res['eta'] = float(values['eta'])
+  res.update((k, int(values[k])) for k in ('gone', 'total') if k in values)
   return toResponse(res, code)
 
 about_updater = lambda *_: [codecs.open('./update_log.txt', encoding='utf-8').read()]
@@ -261,7 +364,7 @@ routes = [
   ('/batch', 'batch.html', '批量放大', None, None, dVer),
   ('/document', 'document.html', None, None, None, dVer),
   ('/about', 'about.html', None, about_updater, ['log'], dVer),
-  ('/system', 'system.html', None, getDynamicInfo, ['disk_free', 'mem_free', 'session', 'path'], getSystemInfo(dVer)),
+  ('/system', 'system.html', None, getDynamicInfo, ['disk_free', 'mem_free', 'jobs', 'workers'], getSystemInfo(dVer)),
   ('/gallery', 'gallery.html', None, gallery, ['var'], dVer),
   ('/lock', 'lock.html', None, None, None, dVer)
 ]
@@ -278,98 +381,219 @@ for item in routes:
 identity = lambda x, *_: x
 readOpt = lambda req: json.loads(req.values['steps'])
 onRequestCache = lambda key: idle() or cache.pop(key)
-controlPoint('/stop', stopCurrent, lambda: E403, lambda *_: E404)
-controlPoint('/msg', onConnect, busy, onRequestCache, checkMsgMatch)
+controlPoint('/stop', stopJob, lambda *_: E404)
+controlPoint('/msg', onConnect, onRequestCache)
+app.route('/events', endpoint='events')(onEvents)
+app.route('/results', endpoint='results')(listResults)
+app.route('/results/<int:jobId>', endpoint='result')(getResult)
 app.route('/log', endpoint='log')(lambda: send_file(logPath, etag=False))
+app.route('/profiles', endpoint='profiles')(listProfiles)
+app.route('/profiles/<path:filename>', endpoint='profile')(lambda filename: send_from_directory(profileDir, filename, as_attachment=True))
 app.route('/favicon.ico', endpoint='favicon')(lambda: send_from_directory(app.root_path, 'logo3.ico'))
-app.route("/{}/.preview.{}".format(outDir, previewFormat), endpoint="preview")(
-  lambda: Response(current.getPreview(), mimetype="image/{}".format(previewFormat)))
+previewPath = '{}/.preview{{}}.{}'.format(outDir, previewFormat)
+
+def getPreview(jobId):
+  job = scheduler.byId(jobId)
+  if not (job and job.worker and job.preview):
+    return E404
+  return Response(job.worker.getPreview(job.preview), mimetype="image/{}".format(previewFormat))
+app.route('/' + previewPath.format('<int:jobId>'), endpoint="preview")(getPreview)
 sendFromDownDir = lambda filename: send_from_directory(downDir, filename)
 app.route("/{}/<path:filename>".format(outDir), endpoint='download')(sendFromDownDir)
-lockFinal = lambda result, *_: (jsonify(result='Interrupted', remain=result), 200) if result > 0 else (jsonify(result='Idle'), 200)
+lockFinal = lambda result, *_: toResponse({'result': 'Interrupted', 'remain': result}) if result > 0 else toResponse({'result': 'Idle'})
 makeHandler('lockInterface', (lambda req: [int(float(readOpt(req)[0]['duration']))]), lockFinal, ['GET', 'POST'])
-makeHandler('systemInfo', (lambda _: []), identity, ['GET', 'POST'])
+app.route('/systemInfo', methods=['GET', 'POST'], endpoint='systemInfo')(systemInfo)
 getReqFile = lambda f: lambda req: f(req, req.files['file'])
-imageEnhancePrep = lambda req, fp: (current.writeFile(fp), *setOutputName(readOpt(req), fp))
+def imageEnhancePrep(req, fp):
+  opt = setOutputName(readOpt(req), fp.filename)
+  return (fp.stream.finish() if isinstance(fp.stream, SlotFile) else arena.write(fp.stream), *opt)
 makeHandler('image_enhance', getReqFile(imageEnhancePrep), responseEnhance)
 app.route('/preset', methods=['GET', 'POST'], endpoint='preset')(preset)
 
-def videoEnhancePrep(req):
+def readParts(req, openFile):
+  """
+  Parse a multipart body while it arrives, without buffering file parts;
+  `openFile(name, filename, fields)` returns a writable file for each file part, given the fields before it.
+  """
+  decoder = MultipartDecoder(req.mimetype_params['boundary'].encode('latin-1'))
+  fields = {}
+  chunks = []
+  out = None
+  def events():
+    while True:
+      data = req.stream.read(1 << 16)
+      decoder.receive_data(data or None)
+      event = decoder.next_event()
+      while not isinstance(event, (NeedData, Epilogue)):
+        yield event
+        event = decoder.next_event()
+      if isinstance(event, Epilogue):
+        return
+      if not data:
+        raise ValueError('Upload incomplete')
+  for event in events():
+    if isinstance(event, Field):
+      name, out, chunks = event.name, None, []
+    elif isinstance(event, File):
+      name, out = event.name, openFile(event.name, event.filename, fields)
+    elif isinstance(event, Data):
+      if out:
+        out.write(event.data)
+      else:
+        chunks.append(event.data)
+      if not event.more_data:
+        if out:
+          out.close()
+        else:
+          fields[name] = b''.join(chunks).decode('utf-8')
+  return fields
+
+def uploadName(filename):
+  """Base name of a client file name, without any directory part."""
+  name = os.path.basename((filename or '').replace('\\', '/')).strip()
+  return name if name.strip('.') else 'upload'
+
+@app.route('/video_enhance', methods=['POST'])
+def videoEnhance():
+  """
+  Uploads are written to disk as they arrive, each into a file of its own under `uploadDir`;
+  if `uploadFollow` is set and the steps come before the file,
+  the job starts right away with ffmpeg following the growing file.
+  """
+  values = request.args.to_dict()
+  if not values.get('session'):
+    return E403
+  job = runningJob(values, request.path)
+  if job:
+    return busy(job)
   if not os.path.exists(uploadDir):
     os.mkdir(uploadDir)
-  for k in ('url', 'cmd'):
-    v = req.values.get(k, None)
-    if v:
-      return (v, k, *readOpt(req))
-  vidfile = req.files['file']
-  path ='{}/{}'.format(uploadDir, vidfile.filename)
-  vidfile.save(path)
-  return (path, False, *setOutputName(readOpt(req), vidfile))
-makeHandler('video_enhance', videoEnhancePrep, responseEnhance)
+  upload = {}
+  def start(source, by, steps, restorable=True):
+    upload['job'] = startJob('video_enhance', (source, by, *steps), responseEnhance, values, request.path, restorable)
+    return upload['job']
+  def openFile(_, filename, fields):
+    upload['filename'] = filename = uploadName(filename)
+    fd, upload['path'] = tempfile.mkstemp(suffix='_' + filename, dir=uploadDir)
+    upload['file'] = fp = os.fdopen(fd, 'wb')
+    if uploadFollow and 'steps' in fields:
+      steps = setOutputName(json.loads(fields['steps']), filename)
+      steps[0]['follow'] = uploadFollow
+      start(upload['path'], False, steps, False)
+    return fp
+  try:
+    values.update(readParts(request, openFile))
+    steps = json.loads(values['steps'])
+    job = upload.get('job')
+    if job is None:
+      by = next((k for k in ('url', 'cmd') if values.get(k)), None)
+      job = start(values[by], by, steps) if by else start(upload['path'], False, setOutputName(steps, upload['filename']))
+    elif type(job) is not tuple: # upload finished, the job can be restored from now on
+      job.task = ('video_enhance', upload['path'], False, *setOutputName(steps, upload['filename']))
+      scheduler.save()
+  except Exception as e:
+    job = upload.get('job')
+    if job and type(job) is not tuple:
+      scheduler.cancel(job)
+    if 'path' in upload: # the partial upload
+      upload['file'].close()
+      tryFunc(os.remove, upload['path'])
+    res = (str(e), 400)
+    cache.put(request.path + str(values['session']), res)
+    return res
+  if type(job) is tuple:
+    if 'path' in upload: # the upload is only owned by this request
+      tryFunc(os.remove, upload['path'])
+    return job
+  return job.result.get()
+
+def batchRun(job, fileList, opt, output_path):
+  """
+  Sends images in chunks for the worker to stack those in the same shape,
+  keeps 2 chunks in flight, so the next chunk is staged into shared memory while the worker runs the current one;
+  the worker writes outputs in background and sends their previews when written.
+  Results are kept for each chunk, a chunk failing only fails its own images.
+  """
+  def run(worker):
+    count = 0
+    chunks = [] # (names, failed names) of each chunk
+    total = len(fileList)
+    logging.info('batch total: {}'.format(total))
+    job.setETA = False
+    files = iter(fileList)
+    inFlight = deque()
+    start = time.time()
+    def record(names, failed):
+      nonlocal count
+      chunks.append((names, failed))
+      count += len(names)
+      note = {
+        'eta': (total - count) * (time.time() - start) / count,
+        'gone': count,
+        'total': total
+      }
+      updateETA(job, note)
+      notify(job, note, True)
+    def stage():
+      images = [] if job.stopped or worker.stopFlag.is_set() else list(islice(files, batchSize))
+      if not len(images):
+        return
+      names = [os.path.join(output_path, image.filename) for image in images]
+      slots = []
+      try:
+        for image in images:
+          slots.append(arena.write(image.stream))
+        worker.send('batch', [slot.desc for slot in slots], names, *opt)
+      except Exception:
+        logging.exception('staging batch failed')
+        for slot in slots:
+          slot.free()
+        record(names, set(names))
+        return stage()
+      inFlight.append((slots, names))
+    stage()
+    stage()
+    while len(inFlight):
+      slots, names = inFlight.popleft()
+      try:
+        output, code = worker.receive()
+      finally:
+        for slot in slots:
+          slot.free()
+      stage()
+      record(names, set(output['result']) if code == 200 else set(names))
+    failed = set(worker.call('flush'))
+    done = [name for names, fails in chunks for name in names if not (name in fails or name in failed)]
+    fails = [name for names, fails in chunks for name in names if name in fails or name in failed]
+    result = 'Success' if count == total else 'Interrupted'
+    return {'result': (result, count, done, len(fails), fails, output_path)}
+  return run
 
 @app.route('/batch_enhance', methods=['POST'])
 def batchEnhance():
-  c = acquireSession(request)
-  if c:
-    return c
-  current.stopFlag.clear()
-  count = 0
-  fail = 0
-  fails = []
-  done = []
-  result = 'Success'
+  if not request.values.get('session'):
+    return E403
   fileList = request.files.getlist('file')
   output_path = '{}/{}/'.format(outDir, int(time.time()))
   if not os.path.exists(output_path):
     os.makedirs(output_path)
   opt = readOpt(request)
-  total = len(fileList)
-  logging.info('batch total: {}'.format(total))
-  opt.append(dict(trace=False, op='output'))
-  current.setETA = False
-  for image in fileList:
-    if current.stopFlag.is_set():
-      result = 'Interrupted'
-      break
-    name = os.path.join(output_path, image.filename)
-    start = time.time()
-    opt[-1]['file'] = name
-    current.fileSize = current.writeFile(image)
-    sender.send(('batch', current.fileSize, *opt))
-    while not receiver.poll():
-      idle()
-    output = receiver.recv()
-    count += 1
-    note = {
-      'eta': (total - count) * (time.time() - start),
-      'gone': count,
-      'total': total
-    }
-    updateETA(note)
-    if output[1] == 200:
-      note['preview'] = name
-      done.append(name)
-    else:
-      fail += 1
-      fails.append(name)
-    cache.put(current.key, note)
-  current.setETA = True
-  return endSession({'result': (result, count, done, fail, fails, output_path)})
-
-def runserver(taskInSender, taskOutReceiver, noteReceiver, stopEvent, mm, isWindows):
-  global sender, receiver, noter
-  sender = taskInSender
-  receiver = taskOutReceiver
-  noter = noteReceiver
-  current.stopFlag = stopEvent
-  mmView = memoryview(mm) if isWindows else mm.buf
-  current.getPreview = lambda: BytesIO(mmView[:current.fileSize])
-  if not isWindows:
-    mm = mm.buf.obj
-  def writeFile(file):
-    mm.seek(0)
-    return file._file.readinto(mm)
-  current.writeFile = writeFile
+  opt.append(dict(trace=False, op='output', writeBehind=True))
+  job = newJob(request.values, request.path, None, models=modelKeys(opt))
+  if type(job) is tuple:
+    return job
+  job.run = batchRun(job, fileList, opt, output_path)
+  job.final = identity
+  return submitJob(job).result.get()
+
+def runserver(workers):
+  global scheduler, arena
+  arena = Arena(config['sharedMemSize'])
+  atexit.register(arena.clear)
+  atexit.register(cache.close)
+  scheduler = Scheduler([Worker(i, *w) for i, w in enumerate(workers)], config['jobsPath'], updateNote, endJob)
+  logging.info('{} workers started'.format(len(workers)))
+  scheduler.load(makeRun, cache.lastId())
   def f(host, port):
     app.debug = False
     app.config['SERVER_NAME'] = None
@@ -377,4 +601,4 @@ def runserver(taskInSender, taskOutReceiver, noteReceiver, stopEvent, mm, isWind
     logging.info('Current working directory: {}'.format(cwd))
     logging.info('Server starts to listen on http://{}:{}/, press Ctrl+C to exit.'.format(host, port))
     server.serve_forever()
-  return f
\ No newline at end of file
+  return f
@@ -0,0 +1,211 @@
+import os
+import io
+import sys
+import atexit
+from bisect import bisect
+isWindows = sys.platform[:3] == 'win'
+mmName = 'SharedMemoryMoe'
+align = 1 << 12
+deferred = [] # handles of segments still exported when closed, retried on later closes and at exit
+
+def openSegment(name, size, create=False):
+  if isWindows:
+    from mmap import mmap
+    m = mmap(-1, size, tagname=name)
+    return m, memoryview(m)
+  else: # requires Python >= 3.8
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(name, create, size)
+    return shm, shm.buf
+
+def closeHandles(handles):
+  """Close the handles, returns those still exported."""
+  left = []
+  for handle in handles:
+    try:
+      handle.close()
+    except BufferError:
+      left.append(handle)
+  return left
+
+def closeDeferred():
+  deferred[:] = closeHandles(deferred)
+atexit.register(closeDeferred)
+
+def closeSegment(segment, unlink=False):
+  handle, view = segment
+  view.release()
+  if unlink and not isWindows: # the name goes away now, the memory once the last mapping is closed
+    handle.unlink()
+  deferred[:] = closeHandles(deferred + [handle])
+
+class MemoryFile(io.RawIOBase):
+  """File-like reader and writer over a memoryview, without copying."""
+  def __init__(self, view):
+    self.view = view
+    self.pos = 0
+    self.end = 0
+
+  readable = writable = seekable = lambda *_: True
+
+  def readinto(self, b):
+    n = max(0, min(len(b), len(self.view) - self.pos))
+    b[:n] = self.view[self.pos:self.pos + n]
+    self.pos += n
+    return n
+
+  def write(self, b):
+    b = memoryview(b).cast('B')
+    n = len(b)
+    if self.pos + n > len(self.view):
+      raise IOError('Shared memory slot is full')
+    self.view[self.pos:self.pos + n] = b
+    self.pos += n
+    self.end = max(self.end, self.pos)
+    return n
+
+  def seek(self, offset, whence=0):
+    self.pos = offset if whence == 0 else self.pos + offset if whence == 1 else len(self.view) + offset
+    return self.pos
+
+  def tell(self):
+    return self.pos
+
+  def close(self):
+    self.view.release()
+    super().close()
+
+class SlotFile(MemoryFile):
+  """
+  Writes into a slot of unknown final length, the unused tail goes back to the arena when finished;
+  the slot is freed if the file is closed unfinished.
+  """
+  def __init__(self, slot):
+    super().__init__(slot.view())
+    self.slot = slot
+    self.done = False
+
+  def finish(self):
+    self.done = True
+    self.slot.length = self.end
+    self.slot.arena.shrink(self.slot)
+    self.close()
+    return self.slot
+
+  def close(self):
+    super().close()
+    if not self.done:
+      self.done = True
+      self.slot.free()
+
+class Segments():
+  """Named shared memory segments attached on demand, slots are given by (segment name, offset, size)."""
+  def __init__(self):
+    self.segments = {}
+
+  def view(self, desc):
+    name, offset, size = desc
+    segment = self.segments.get(name)
+    if segment is None or len(segment[1]) < offset + size:
+      segment and closeSegment(segment)
+      segment = self.segments[name] = openSegment(name, offset + size)
+    return segment[1][offset:offset + size]
+
+  def open(self, desc):
+    return MemoryFile(self.view(desc))
+
+  def clear(self):
+    for segment in self.segments.values():
+      closeSegment(segment)
+    self.segments.clear()
+
+class Slot():
+  def __init__(self, arena, name, offset, size, length):
+    self.arena = arena
+    self.name = name
+    self.offset = offset
+    self.size = size
+    self.length = length
+
+  @property
+  def desc(self):
+    return (self.name, self.offset, self.length)
+
+  def view(self):
+    return self.arena.view(self.desc)
+
+  def free(self):
+    if self.arena:
+      self.arena.release(self.name, self.offset, self.size)
+      self.arena = None
+
+class Arena(Segments):
+  """
+  Allocates slots from owned segments by first fit on a free list,
+  adds a segment when no free block fits and drops extra segments once they are empty.
+  """
+  def __init__(self, segmentSize, prefix=None):
+    super().__init__()
+    self.segmentSize = segmentSize
+    self.prefix = prefix or '{}{}_'.format(mmName, os.getpid())
+    self.sizes = {}
+    self.free = [] # sorted (name, offset, size)
+    self.count = 0
+
+  def grow(self, size):
+    name = '{}{}'.format(self.prefix, self.count)
+    self.count += 1
+    segment = self.segments[name] = openSegment(name, max(self.segmentSize, size), True)
+    self.sizes[name] = len(segment[1])
+    self.free.append((name, 0, self.sizes[name]))
+    self.free.sort()
+
+  def alloc(self, length):
+    size = -(-max(length, 1) // align) * align
+    for i, (name, offset, blockSize) in enumerate(self.free):
+      if blockSize >= size:
+        if blockSize > size:
+          self.free[i] = (name, offset + size, blockSize - size)
+        else:
+          del self.free[i]
+        return Slot(self, name, offset, size, length)
+    self.grow(size)
+    return self.alloc(length)
+
+  def release(self, name, offset, size):
+    blocks = self.free
+    i = bisect(blocks, (name, offset))
+    blocks.insert(i, (name, offset, size))
+    if i + 1 < len(blocks) and blocks[i + 1][0] == name and blocks[i + 1][1] == offset + size:
+      blocks[i] = (name, offset, size + blocks.pop(i + 1)[2])
+    if i and blocks[i - 1][0] == name and sum(blocks[i - 1][1:]) == offset:
+      i -= 1
+      blocks[i] = (name, blocks[i][1], blocks[i][2] + blocks.pop(i + 1)[2])
+    if blocks[i][2] == self.sizes[name] and name != self.prefix + '0':
+      del blocks[i]
+      del self.sizes[name]
+      closeSegment(self.segments.pop(name), True)
+
+  def shrink(self, slot):
+    size = -(-max(slot.length, 1) // align) * align
+    if size < slot.size:
+      self.release(slot.name, slot.offset + size, slot.size - size)
+      slot.size = size
+
+  def write(self, file):
+    """Copy the rest of a file object into a new slot."""
+    start = file.tell()
+    size = file.seek(0, 2) - start
+    file.seek(start)
+    slot = self.alloc(size)
+    view = slot.view()
+    slot.length = file.readinto(view)
+    view.release()
+    return slot
+
+  def clear(self):
+    for name, segment in self.segments.items():
+      closeSegment(segment, True)
+    self.segments.clear()
+    self.sizes.clear()
+    self.free.clear()
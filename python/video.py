@@ -6,20 +6,19 @@ import threading
 import logging
 import signal
 from math import ceil
-from queue import Queue, Empty
 from gevent import idle
 from config import config
 from imageProcess import clean
 from procedure import genProcess
-from progress import Node, initialETA
+from progress import Node, initialETA, timeStage
 from worker import context, begin
 from IFRNet import RefTime as SlomoRefs
 from videoSR import RefTime as VSRRefs
 from ESTRNN import para as ESTRNNpara
 
 log = logging.getLogger('Moe')
+ffmpegLog = logging.getLogger('ffmpeg') # progress lines are sampled
 ffmpegPath = os.path.realpath('ffmpeg/bin/ffmpeg') # require full path to spawn in shell
-qOut = Queue(256)
 stepVideo = [dict(op='buffer', bitDepth=16)]
 pix_fmt = 'bgr48le'
 pixBytes = 6
@@ -54,7 +53,18 @@ def removeFile(path):
   except PermissionError as e:
     log.error(str(e))
 
-def getVideoInfo(videoPath, by, width, height, frameRate):
+def followInput(command, path, timeout):
+  """Let ffmpeg keep reading an input file that is still being written, until no data comes in `timeout` seconds."""
+  if not timeout:
+    return command
+  res = []
+  for arg in command:
+    if arg == path and res[-1:] == ['-i']:
+      res[-1:] = ['-follow', '1', '-rw_timeout', str(int(timeout * 1e6)), '-i']
+    res.append(arg)
+  return res
+
+def getVideoInfo(videoPath, by, width, height, frameRate, follow=0):
   commandIn = [
     ffmpegPath,
     '-hide_banner',
@@ -67,7 +77,7 @@ def getVideoInfo(videoPath, by, width, height, frameRate):
     '-'
   ]
   matchInfo = not (width and height and frameRate)
-  matchFrame = not by
+  matchFrame = not (by or follow) # counting frames of a growing file would wait for the whole upload
   matchOutput = True
   error = RuntimeError('Video info not found')
   videoOnly = True
@@ -76,16 +86,16 @@ def getVideoInfo(videoPath, by, width, height, frameRate):
   if matchFrame:
     commandIn = clipList(commandIn, 2, 4)
   try:
-    procIn = popenText(commandIn)
+    procIn = popenText(followInput(commandIn, videoPath, follow))
     totalFrames = 0
 
     while matchInfo or matchOutput or matchFrame:
       line = procIn.stderr.readline()
       if type(line) != str:
         line = str(line, 'utf-8', errors='ignore')
-      sys.stdout.write(line)
       if not line:
         break
+      ffmpegLog.info(line.rstrip())
       line = line.lstrip()
       if reMatchOutput.match(line):
         matchOutput = False
@@ -119,30 +129,25 @@ def getVideoInfo(videoPath, by, width, height, frameRate):
   log.info('Info of video {}: {}x{}@{}fps, {} frames'.format(videoPath, width, height, frameRate, totalFrames))
   return width, height, frameRate, totalFrames, videoOnly
 
-def enqueueOutput(out, queue):
+def enqueueOutput(out):
+  """Log ffmpeg output on this thread, progress lines end with carriage returns."""
   try:
     for line in iter(out.readline, b''):
-      queue.put(line)
+      if not type(line) == str:
+        line = str(line, encoding='utf_8', errors='replace')
+      for part in line.split('\r'):
+        part = part.rstrip()
+        if part:
+          ffmpegLog.info(part)
     out.flush()
   except Exception:
-    queue.put('FFMpeg output pipe Exception')
+    ffmpegLog.warning('FFMpeg output pipe Exception')
 
-def createEnqueueThread(pipe, *args):
-  t = threading.Thread(target=enqueueOutput, args=(pipe, qOut, *args))
+def createEnqueueThread(pipe):
+  t = threading.Thread(target=enqueueOutput, args=(pipe,))
   t.daemon = True # thread dies with the program
   t.start()
 
-def readSubprocess(q):
-  while True:
-    try:
-      line = q.get_nowait()
-      if not type(line) == str:
-        line = str(line, encoding='utf_8', errors='replace')
-    except Empty:
-      break
-    else:
-      sys.stdout.write(line)
-
 def prepare(video, by, steps):
   optEncode = steps[-1]
   encodec = optEncode.get('codec', config.defaultEncodec)  # pylint: disable=E1101
@@ -315,29 +320,49 @@ def mergeAV(command):
     procMerge = popenText(command)
     createEnqueueThread(procMerge.stderr)
     err, msg = procMerge.communicate()
-    sys.stdout.write(msg)
+    msg and ffmpegLog.info(msg.rstrip())
     return procMerge, err
   else:
     return 0, 0
 
+def padEnd(steps, refs, stop, count):
+  """Tell video models to pad frames after the input ended at `count` frames, returns the reference frames left."""
+  arefs = 0 if stop <= 0 or count < stop else count - stop
+  for step in steps:
+    if arefs >= refs:
+      break
+    if step['op'] == 'slomo':
+      refs = refs * step['sf'] + step['opt'].outEnd # outEnd is negative
+      step['opt'].outEnd = 0
+      arefs = arefs * step['sf']
+    elif step['op'] in padOp:
+      step['opt'].end = -min(refs - arefs, lookahead[step['op']])
+      refs += step['opt'].end
+  return refs
+
 def SR_vid(video, by, *steps):
   def p(raw_image=None):
     bufs = process((raw_image, height, width))
     if (not bufs is None) and len(bufs):
       for buffer in bufs:
         if buffer:
-          procOut.stdin.write(buffer)
+          write(buffer)
     return 0 if bufs is None else len(bufs)
 
   context.stopFlag.clear()
   outputPath, process, *args = prepare(video, by, steps)
+  process = timeStage('process', process)
   start, stop, refs, root = args[:4]
   root.callback(root, dict(eta=100000))
-  width, height, *more = getVideoInfo(video, by, *args[-3:])
+  follow = steps[0].get('follow', 0)
+  width, height, *more = getVideoInfo(video, by, *args[-3:], follow)
   root.callback(root, dict(shape=[height, width], fps=more[0], eta=60000))
   commandIn, commandVideo, commandOut = setupInfo(by, outputPath, *args[3:9], start, width, height, *more)
+  commandIn, commandVideo = (followInput(command, video, follow) for command in (commandIn, commandVideo))
   procIn = popen(commandIn)
   procOut = sp.Popen(commandVideo, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, bufsize=0)
+  read = timeStage('decode', procIn.stdout.read)
+  write = timeStage('pipeWait', procOut.stdin.write)
   procMerge = 0
   err = 0
 
@@ -348,10 +373,9 @@ def SR_vid(video, by, *steps):
     i = 0
     frameBytes = width * height * pixBytes # read 1 frame
     while (stop < 0 or i <= stop + refs) and not context.stopFlag.is_set():
-      raw_image = procIn.stdout.read(frameBytes)
+      raw_image = read(frameBytes)
       if len(raw_image) == 0:
         break
-      readSubprocess(qOut)
       if i >= start:
         p(raw_image)
       elif (i + 1) % 10 == 0:
@@ -359,24 +383,13 @@ def SR_vid(video, by, *steps):
       i += 1
       idle()
     os.kill(procIn.pid, sigint)
-    if len(raw_image) == 0: # tell VSR to pad frames
-      arefs = 0 if stop <= 0 or i < stop else i - stop
-      for step in steps:
-        if arefs >= refs:
-          break
-        if step['op'] == 'slomo':
-          refs = refs * step['sf'] + step['opt'].outEnd # outEnd is negative
-          step['opt'].outEnd = 0
-          arefs = arefs * step['sf']
-        elif step['op'] in padOp:
-          step['opt'].end = -min(refs - arefs, lookahead[step['op']])
-          refs += step['opt'].end
+    if len(raw_image) == 0:
+      refs = padEnd(steps, refs, stop, i)
     p()
 
-    procOut.communicate(timeout=300)
+    timeStage('encode', procOut.communicate)(timeout=300)
     procIn.terminate()
-    readSubprocess(qOut)
-    procMerge, err = mergeAV(commandOut)
+    procMerge, err = timeStage('encode', mergeAV)(commandOut)
   finally:
     log.info('Video processing end at frame #{}.'.format(i - refs))
     procIn.terminate()
@@ -393,5 +406,4 @@ def SR_vid(video, by, *steps):
       log.warning('Unable to merge video and other tracks with exit code {}.'.format(err))
     else:
       outputPath = cleanAV(commandOut, outputPath)
-  readSubprocess(qOut)
   return outputPath, i - refs
\ No newline at end of file
@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from imageProcess import ceilBy, StreamState, identity, doCrop
+from imageProcess import ceilBy, StreamState, identity, doCrop, getGrid, warp
 from models import ModulatedDeformConvPack, ResidualBlockNoBN, make_layer, conv2d311
 from runSlomo import getOptS, getOptP, makeStreamFunc
 from progress import Node
@@ -31,14 +31,10 @@ class backWarp(nn.Module):
         computation device (cpu/cuda).
     """
     super(backWarp, self).__init__()
-    # create a grid
-    kwarg = {'indexing': 'ij'} if torch.__version__ >= '1.10' else {}
-    gridY, gridX = torch.meshgrid(torch.arange(H), torch.arange(W), **kwarg)
     self.W = W
     self.H = H
-    self.gridX = gridX.to(dtype=dtype, device=device)
-    self.gridY = gridY.to(dtype=dtype, device=device)
     self.padding_mode = padding_mode
+    getGrid(H, W, dtype, device) # sampling grids are shared, see imageProcess.getGrid
 
   def forward(self, img, flow):
     """
@@ -56,20 +52,8 @@ class backWarp(nn.Module):
       tensor
         frame I0.
     """
-    # Extract horizontal and vertical flows.
-    u = flow[:, 0, :, :]
-    v = flow[:, 1, :, :]
-    x = self.gridX.unsqueeze(0).expand_as(u) + u
-    y = self.gridY.unsqueeze(0).expand_as(v) + v
-    # range -1 to 1
-    x = 2*(x/self.W - 0.5)
-    y = 2*(y/self.H - 0.5)
-    # stacking X and Y
-    grid = torch.stack((x,y), dim=3)
-    # Sample pixels using bilinear interpolation.
     # set both here and interpolate's align_corners to False will occur memory overflow
-    imgOut = torch.nn.functional.grid_sample(img, grid, align_corners=True, padding_mode=self.padding_mode, mode='bilinear')
-    return imgOut
+    return warp(img, flow, padding_mode=self.padding_mode)
 
 conv2d713 = lambda in_channels, out_channels:\
   nn.Conv2d(in_channels, out_channels, kernel_size=7, stride=1, padding=3)
@@ -98,39 +82,36 @@ class SpyNet(nn.Module):
 
     self.register_buffer('mean', torch.Tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
     self.register_buffer('std', torch.Tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
-    self.flow_warp = None
     self.size = None
 
   def preprocess(self, tensor_input):
     tensor_output = (tensor_input - self.mean) / self.std
     return tensor_output
 
-  def forward(self, inp):
-    inp = self.preprocess(inp)
-    ref = [0] * 5 + [inp[:, 0]]
-    supp = [0] * 5 + [inp[:, 1]]
+  def pyramid(self, x):
+    """Normalize frames (n, c, h, w) and build their 6 levels pyramid, small to large."""
+    p = [0] * 5 + [self.preprocess(x)]
+    for i in range(len(p) - 1, 0, -1):
+      p[i - 1] = F.avg_pool2d(input=p[i], kernel_size=2, stride=2, count_include_pad=False)
+    return p
 
-    for i in range(len(ref) - 1, 0, -1):
-      ref[i - 1] = F.avg_pool2d(input=ref[i], kernel_size=2, stride=2, count_include_pad=False)
-      supp[i - 1] = F.avg_pool2d(input=supp[i], kernel_size=2, stride=2, count_include_pad=False)
+  def forward(self, inp):
+    return self.flow(self.pyramid(inp[:, 0]), self.pyramid(inp[:, 1]))
 
+  def flow(self, ref, supp):
     N, _, H, W = ref[0].shape
     flow = ref[0].new_zeros([N, 2, H >> 1, W >> 1])
-    if not self.flow_warp or self.size != [H, W]:
+    if self.size != [H, W]:
       self.size = [H, W]
-      self.flow_warp = []
-      for r in ref:
-        _, _, H, W = r.shape
-        self.flow_warp.append(backWarp(W, H, device=flow.device, dtype=flow.dtype, padding_mode='border'))
+      _, _, H, W = ref[-1].shape
       assert not (H & 63 or W & 63)
 
     for level in range(len(ref)):
       upsampled_flow = F.interpolate(input=flow, scale_factor=2, mode='bilinear', align_corners=True) * 2.0
 
-      f = self.flow_warp[level]
       flow = self.basic_module[level](torch.cat([
         ref[level],
-        f(supp[level], upsampled_flow),
+        warp(supp[level], upsampled_flow, padding_mode='border'),
         upsampled_flow
       ], 1)) + upsampled_flow
 
@@ -404,11 +385,19 @@ def getKeyframeFeature(opt, keyframe, isKeyFrame, **_):
   # do not batchify to ensure consistent memory usage
   return [(doCrop(opt.edvr, torch.stack(w).unsqueeze(0)) if b else None) for w, b in zip(keyframe, isKeyFrame)]
 
-def calcFlowBackward(opt, flowInp, last):
-  b, _, __, h, w = flowInp.size() # [[x_i, x_i+1], ...]
+calcPyramid = lambda opt, x, **_: [list(t) for t in zip(*(level.split(1) for level in opt.spynet.pyramid(x)))]
 
-  flows = opt.spynet(flowInp).view(b, 1, 2, h, w)
-  out = list(flows)
+def calcFlow(opt, pyramids, **_):
+  b = len(pyramids) # [[pyramid_i, pyramid_i+1], ...]
+  level = lambda j, k: [w[j][k] for w in pyramids]
+  # both directions of a window share the cached pyramids and run in one batch
+  ref = [torch.cat(level(0, k) + level(1, k)) for k in range(6)]
+  supp = [torch.cat(level(1, k) + level(0, k)) for k in range(6)]
+  flows = opt.spynet.flow(ref, supp).split(1)
+  return list(zip(flows[:b], flows[b:])) # [(flow x_i <- x_i+1, flow x_i+1 <- x_i), ...]
+
+def calcFlowBackward(opt, flows, last):
+  out = [f[0] for f in flows]
   if last:
     out.append(None)
   return out
@@ -430,19 +419,12 @@ def calcBackward(opt, inp, flowInp, keyframeFeature, last):
     out.insert(0, feat_prop)
   return out # only window[0] for window in out is used
 
-def calcFlowForward(opt, state, flowInp, **_):
+def calcFlowForward(opt, state, flows, **_):
   out = []
   if state.first:
     out.append(None)
-    flowInp = flowInp[1:]
     state.first = 0
-  b, _, __, h, w = flowInp.size()
-  x = torch.empty_like(flowInp) # [[x_i+1, x_i], ...]
-  x[:, 0] = flowInp[:, 1]
-  x[:, 1] = flowInp[:, 0]
-
-  flows = opt.spynet(x).view(b, 1, 2, h, w)
-  out.extend(list(flows))
+  out.extend(f[1] for f in flows)
   return out
 
 def calcForward(opt, state, inp, flowInp, keyframeFeature, backward, **_):
@@ -474,7 +456,8 @@ newFusion = lambda *_: conv2d311(2 * NumFeat, NumFeat)
 modules = dict(
   edvr=dict(weight='edvr', outShape=(1, NumFeat, 1, 1), staticDims=[0],
     f=lambda *_: EDVRFeatureExtractor(RefTime, NumFeat)),
-  spynet=dict(weight='spynet', f=SpyNet, streams=['flowBackward', 'flowForward']),
+  spynet=dict(weight='spynet', f=SpyNet, streams=['flowBackward', 'flowForward'],
+    ramCoef=[ramCoef[i] / 2 for i in (1, 8, 15)]), # a window runs its forward and backward flows together
   backward_trunk=dict(weight='backward_trunk', outShape=(1, NumFeat, 1, 1), staticDims=[0],
     f=lambda *_: ConvResidualBlocks(NumFeat + 3, NumFeat, 30)),
   forward_trunk=dict(weight='forward_trunk', outShape=(1, NumFeat, 1, 1), staticDims=[0],
@@ -500,18 +483,20 @@ def initFunc(opt, x):
   return height, width
 
 def doVSR(func, node, opt):
-  nodes = [Node({'IconVSR': key}) for key in ('KeyframeFeature', 'Flow', 'Backward', 'Flow', 'Forward', 'upsample')]
+  nodes = [Node({'IconVSR': key}) for key in ('KeyframeFeature', 'Flow', 'Backward', 'Forward', 'upsample')]
   inp = StreamState(offload=False)
   inp1 = StreamState()
   inp2 = StreamState()
   backwardInp = StreamState()
-  flowInp = StreamState(2, offload=False)
-  flowForwardInp = StreamState(offload=False).setPadding(1)
-  flowBackwardInp = StreamState(offload=False)
+  flowInp = StreamState(offload=False)
+  pyramids = StreamState(2, tensor=False, offload=False)
+  flowForwardInp = StreamState(tensor=False, offload=False)
+  flowBackwardInp = StreamState(tensor=False, offload=False)
   isKeyFrame = KeyFrameState(RefTime)
   keyframeFeatureInp = StreamState(RefTime, tensor=False, reserve=1, offload=False)
   StreamState.pipe(identity, [inp], [inp1, inp2, flowInp, backwardInp])
-  StreamState.pipe(identity, [flowInp], [flowForwardInp, flowBackwardInp])
+  StreamState.pipe(calcPyramid, [flowInp], [pyramids], args=[opt])
+  StreamState.pipe(nodes[1].bindFunc(calcFlow), [pyramids], [flowForwardInp, flowBackwardInp], args=[opt])
   keyframeFeature = StreamState(tensor=False, offload=False)
   StreamState.pipe(nodes[0].bindFunc(getKeyframeFeature),
     [keyframeFeatureInp, isKeyFrame], [keyframeFeature], args=[opt], size=7)
@@ -519,21 +504,21 @@ def doVSR(func, node, opt):
   keyframeFeature2 = StreamState(tensor=False)
   StreamState.pipe(identity, [keyframeFeature], [keyframeFeature1, keyframeFeature2])
   flowBackward = StreamState(tensor=False)
-  opt.flowBackward = StreamState.pipe(nodes[1].bindFunc(calcFlowBackward),
+  opt.flowBackward = StreamState.pipe(calcFlowBackward,
     [flowBackwardInp], [flowBackward], args=[opt], size=1)
   backward = StreamState(3, tensor=False)
   StreamState.pipe(nodes[2].bindFunc(calcBackward),
     [backwardInp, flowBackward, keyframeFeature1], [backward], args=[opt], size=20)
   flowForward = StreamState(tensor=False, offload=False)
   flowForward.first = 1 # signal alignment for frame 0, 1
-  opt.flowForward = StreamState.pipe(nodes[3].bindFunc(calcFlowForward),
+  opt.flowForward = StreamState.pipe(calcFlowForward,
     [flowForwardInp], [flowForward], args=[opt, flowForward], size=1)
   forward = StreamState(offload=False)
   forward.feat_prop = None
-  StreamState.pipe(nodes[4].bindFunc(calcForward),
+  StreamState.pipe(nodes[3].bindFunc(calcForward),
     [inp1, flowForward, keyframeFeature2, backward], [forward], args=[opt, forward])
   upsample = StreamState(store=False)
-  opt.out = StreamState.pipe(nodes[5].bindFunc(doUpsample),
+  opt.out = StreamState.pipe(nodes[4].bindFunc(doUpsample),
     [inp2, forward], [upsample], args=[opt], size=1)
   def pushFunc(x):
     if opt.i + opt.startPadding >= RefTime >> 1:
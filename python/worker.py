@@ -1,15 +1,23 @@
-from io import BytesIO
+import logging
 from traceback import format_exc
-from gevent import idle
-from progress import setCallback, initialETA, saveOps, loadOps, clearOps
+from threading import Lock
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from ipc import receive, Notifier
+from progress import setCallback, initialETA, saveOps, loadOps, clearOps, setDevice
 from config import config
-from logger import initLogging
+from logger import initLogging, indexedPath
+from sharedMemory import Segments, Arena, MemoryFile
 
 def context(): pass
 context.root = None
-context.getFile = lambda size: BytesIO(context.sharedView[:size])
-log = initLogging(config.logPath).getLogger('Moe') # pylint: disable=E1101
+context.profiler = None # stepped by root progress while a video is profiled
+context.getFile = lambda desc: context.inputs.open(desc)
+log = logging.getLogger('Moe')
 opsPath = config.opsPath # pylint: disable=E1101
+writer = ThreadPoolExecutor(2)
+pending = [] # (name, future) of background writes
+slotLock = Lock() # previews are written to slots from the encoder thread
 getInfo = lambda f, args: [f.__name__] + [filterOpt(arg) for arg in args]
 
 def filterOpt(item):
@@ -22,6 +30,7 @@ def filterOpt(item):
 
 def begin(root, nodes=[], setAllCallback=True, bench=False, clear=False):
   context.root = root
+  setDevice(config.getRunType()) # pylint: disable=E1101
   root.nodes = []
   for n in nodes:
     root.append(n)
@@ -42,13 +51,58 @@ def onProgress(node, kwargs={}):
   } if context.root else {}
   res.update(kwargs)
   saveOps(opsPath)
+  if context.profiler and node is context.root:
+    context.profiler.step()
   if hasattr(node, 'name') and node.gone < node.total:
     res['stage'] = node.name
     if node.total > 1:
       res['stageProgress'] = node.gone
       res['stageTotal'] = node.total
+  notify(res)
+
+def notify(res):
   context.notifier.send(res)
 
+def writeBehind(write):
+  """Run `write` on a writer thread, the image mode is captured at submission; sends a preview note when written."""
+  def f(image, name, ctx, *args):
+    state = SimpleNamespace(imageMode=ctx.imageMode, palette=getattr(ctx, 'palette', None))
+    def run():
+      write(image, name, state, *args)
+      notify({'preview': name})
+    pending.append((name, writer.submit(run)))
+    return name
+  return f
+
+def setWriters(count):
+  global writer
+  writer = ThreadPoolExecutor(count)
+
+def flush():
+  """Wait for background writes, returns names of failed ones."""
+  failed = []
+  for name, future in pending:
+    e = future.exception()
+    if e:
+      log.error('write {} failed: {}'.format(name, e))
+      failed.append(name)
+  pending.clear()
+  return failed
+
+def writeShared(write, capacity):
+  """Write output into a new slot of the worker's arena, keeps the last 2 slots for readers."""
+  with slotLock:
+    slot = context.outputs.alloc(capacity)
+  f = MemoryFile(slot.view())
+  write(f)
+  slot.length = f.end
+  f.close()
+  with slotLock:
+    context.slots.append(slot)
+    if len(context.slots) > 2:
+      context.slots.pop(0).free()
+  return slot.desc
+
 def enhance(f, verbose=True):
   def g(*args, **kwargs):
     try:
@@ -66,29 +120,28 @@ def enhance(f, verbose=True):
         'exception': format_exc()
       }
       code = 400
-      context.notifier.send(res)
+      notify(res)
     finally:
       from imageProcess import clean
       clean()
     return res, code
   return g
 
-def worker(main, taskIn, taskOut, notifier, stopEvent, isWindows):
+def worker(main, args, taskIn, taskOut, notifier, stopEvent):
   global routes
-  mm, routes = main()
-  if isWindows:
-    context.sharedView = memoryview(mm)
-    context.shared = mm
-  else:
-    context.sharedView = mm.buf
-    context.shared = mm.buf.obj
-  context.shared.seek(0)
-  context.notifier = notifier
+  index = args[0]
+  initLogging(indexedPath(config.logPath, index), indexedPath(config.ffmpegLogPath, index)) # pylint: disable=E1101
+  routes = main(*args)
+  context.inputs = Segments()
+  context.outputs = Arena(config.sharedMemSize) # pylint: disable=E1101
+  context.slots = []
+  context.notifier = Notifier(notifier, config.notifyInterval) # pylint: disable=E1101
   context.stopFlag = stopEvent
   loadOps(opsPath)
   while True:
-    idle()
-    task = taskIn.recv()
+    task = receive(taskIn)
     stopEvent.clear()
     result = routes[task[0]](*task[1:])
-    taskOut.send(result)
\ No newline at end of file
+    context.inputs.clear()
+    context.notifier.flush()
+    taskOut.send(result)
@@ -1,5 +1,5 @@
 import $ from 'jquery'
-import { newMessager, texts } from './common.js'
+import { newMessager, newPushMessager, texts } from './common.js'
 import { onSummaryMessage } from './summary.js'
 const reconnectPeriod = 5
 const setComparison = opt =>
@@ -73,7 +73,9 @@ const setup = opt => {
   loading.hide()
   downloader.hide()
 
-  const messager = newMessager('/msg', opt.session)
+  const messager = window.EventSource
+    ? newPushMessager('/events', opt.session)
+    : newMessager('/msg', opt.session)
   const onMessage = event => {
     if (event.data) {
       let result = event.data.result
@@ -20,7 +20,7 @@ import './move-top.min.js'
 import './easing.js'
 import './numscroller-1.0.js'
 import './custom-file-input.js'
-import { getSession, newMessager } from './message.js'
+import { getSession, newMessager, newPushMessager } from './message.js'
 const compareVersion = (a, b) => {
   a = a.split('.')
   b = b.split('.')
@@ -92,6 +92,7 @@ const texts = {
   scale: '倍',
   duplicateFrame: '时认为是重复帧，',
   cameraCut: '时认为是切镜头',
+  staticFrame: '像素时直接混合',
   noFile: '请选择',
   noFileMsg: '缺少输入文件',
   errorMsg: '出错啦',
@@ -106,6 +107,7 @@ const texts = {
   samples: '样本数',
   mark: '得分',
   clearMetric: '清除以往测速结果',
+  profile: '性能剖析，结果见/profiles',
   processing: processingMsg,
   stopping: '等待保存已处理部分',
   logWritten: '日志已写入浏览器控制台，请按<kbd>F12</kbd>查看',
@@ -119,6 +121,7 @@ const texts = {
     unknown: '未知'
   },
   onBusy: gone => '忙碌中' + (gone == null ? '' : `，已经过${toHMS(gone)}`),
+  queued: n => `排队中，前面还有${n}个任务`,
   timeFormatter: time => `，预计还需要${toHMS(time)}`,
   batchSucc: result =>
     [
@@ -152,6 +155,7 @@ export {
   getResource,
   getSession,
   newMessager,
+  newPushMessager,
   appendText,
   texts,
   setLanguage,
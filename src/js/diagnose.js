@@ -30,7 +30,8 @@ const genDiagnoseArgs = () => {
       classes: ['input-text', 'input-short'],
       values: [
         { value: 'bench', text: texts.bench },
-        { value: 'clear', text: texts.clearMetric }
+        { value: 'clear', text: texts.clearMetric },
+        { value: 'profile', text: texts.profile }
       ]
     }
   ]
@@ -801,6 +801,28 @@ const panels = {
         value: 0.6,
         classes: ['input-number'],
         attributes: ['min="0"', 'max="1"', 'step="0.05"']
+      },
+      adaptive: {
+        type: 'checkbox',
+        text: '按运动幅度自适应插帧',
+        values: [
+          {
+            value: 'enable',
+            binds: ['motion']
+          }
+        ],
+        notes: [
+          '先在最粗糙的尺度上估计相邻两帧间的光流，运动很小的两帧直接线性混合出中间帧，只有运动较大的才完整处理',
+          '适合说话人像、动画等大部分画面静止的视频，能快很多'
+        ]
+      },
+      motion: {
+        type: 'number',
+        text: '光流幅度小于',
+        view: appendText('staticFrame'),
+        value: 1,
+        classes: ['input-number'],
+        attributes: ['min="0"', 'step="0.1"']
       }
     }
   }
@@ -19,23 +19,8 @@ const encodeParams = o =>
   Object.entries(o)
     .map(encodeParam)
     .join('&')
-export const newMessager = (url, session, opt = {}) => {
-  var m = { url, session, xhr: null, status: 0 }
-
+const addListeners = m => {
   var listeners = {}
-
-  var opt = Object.assign({}, defaultOpt, opt)
-  const getUrl = data => `${m.url}?${encodeParams(Object.assign({ session: m.session }, data))}`
-  const onError = a => m.fire({ type: 'error', data: a[0], error: a[1] })
-  const pend = res => {
-    m.status
-      ? (m.xhr = fetch(getUrl(), opt)
-        .then(formatData)
-        .catch(onError)
-        .then(data => m.fire({ type: 'message', data })))
-      : (m.xhr = null)
-    return res
-  }
   m.on = (type, listener) => {
     type = String(type)
     var ls, i
@@ -48,8 +33,6 @@ export const newMessager = (url, session, opt = {}) => {
     if (i < 0) ls.push(listener)
     return m
   }
-  m.on('message', pend)
-  m.on('open', pend)
   m.removeEventListener = (type, listener) => {
     type = String(type)
     var ls = listeners[type]
@@ -74,10 +57,30 @@ export const newMessager = (url, session, opt = {}) => {
       }
     })
   }
+  return m
+}
+const getUrl = (m, data) =>
+  `${m.url}?${encodeParams(Object.assign({ session: m.session }, data))}`
+export const newMessager = (url, session, opt = {}) => {
+  var m = addListeners({ url, session, xhr: null, status: 0 })
+
+  var opt = Object.assign({}, defaultOpt, opt)
+  const onError = a => m.fire({ type: 'error', data: a[0], error: a[1] })
+  const pend = res => {
+    m.status
+      ? (m.xhr = fetch(getUrl(m), opt)
+        .then(formatData)
+        .catch(onError)
+        .then(data => m.fire({ type: 'message', data })))
+      : (m.xhr = null)
+    return res
+  }
+  m.on('message', pend)
+  m.on('open', pend)
   m.open = data => {
     if (!m.status) {
       m.status = 1
-      m.xhr = fetch(getUrl(data), opt)
+      m.xhr = fetch(getUrl(m, data), opt)
         .then(formatData)
         .catch(onError)
         .then(data => m.fire({ type: 'open', data }))
@@ -87,6 +90,44 @@ export const newMessager = (url, session, opt = {}) => {
   m.abort = _ => (m.status = 0)
   return m
 }
+const parseData = str => {
+  try {
+    return str ? JSON.parse(str) : void 0
+  } catch (e) {
+    return str
+  }
+}
+// same interface as newMessager, the server pushes merged progress until the result comes
+export const newPushMessager = (url, session) => {
+  var m = addListeners({ url, session, xhr: null, status: 0 })
+
+  m.open = data => {
+    if (!m.status) {
+      m.status = 1
+      let type = 'open'
+      let source = (m.xhr = new EventSource(getUrl(m, data)))
+      source.onmessage = e => {
+        let data = parseData(e.data)
+        ;(!data || data.result != null) && m.abort()
+        m.fire({ type, data })
+        type = 'message'
+      }
+      source.addEventListener('failure', e => {
+        m.abort()
+        m.fire({ type: 'error', data: parseData(e.data) })
+      })
+      source.onerror = _ =>
+        m.status && (m.abort(), m.fire({ type: 'error', data: void 0 }))
+    }
+    return m.xhr
+  }
+  m.abort = _ => {
+    m.status = 0
+    m.xhr && m.xhr.close()
+    m.xhr = null
+  }
+  return m
+}
 export const getSession = _ => {
   var cookie = window.document.cookie
   let start = cookie.indexOf('session=') + 8
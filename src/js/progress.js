@@ -124,6 +124,8 @@ const setupProgress = opt => {
     }
     data.gone
       ? progress.setStatus(opt.onProgress(data.gone, total, data))
+      : data.queue != null
+      ? progress.setStatus(texts.queued(data.queue))
       : data.eta
       && progress.setStatus(texts.onBusy(null))
     data.skip && opt.onSkip && opt.onSkip(data.skip)
@@ -556,7 +556,12 @@ const serializeSteps = (toFile, data = new Map()) =>
     })
     .filter(opt => !!opt)
 
-const submit = data =>
-  data.set('steps', JSON.stringify(serializeSteps(null, data)))
+const submit = data => {
+  const files = new FormData()
+  data.set('steps', JSON.stringify(serializeSteps(null, files)))
+  // files go after the steps so that the server can start while uploading
+  for (const [key, value] of files) data.append(key, value)
+  data.noCheckFile = files.noCheckFile
+}
 
 export { addPanel, initListeners, submit, serializeSteps, context, getOptions }
@@ -1,52 +1,180 @@
-
-# coding: utf-8
-
-# In[1]:
-
-
-import torch
+"""
+Throughput of every model on random frames: seconds per megapixel, peak memory and tiles cropped per frame
+at several resolutions, written as JSON and CSV to be compared across commits.
+Models without checkpoints run with random weights, timings are still representative.
+Run from the repository root: python test/benchmark.py [--cpu] [-r 256x256,512x512] [-m 'SR/*'] [-o .user/benchmark]
+"""
+# pylint: disable=E1101
+import os
 import sys
+import csv
+import json
+import time
+import fnmatch
+import argparse
+import platform
+import threading
+import subprocess as sp
+from copy import deepcopy
+import numpy as np
+import torch
 sys.path.append('./python')
-from progress import initialETA, ops, newOp, slideAverage
-from imageProcess import genProcess
-from config import config
-
-inTensor = torch.randn((3, 1080, 1920), dtype=config.dtype(), device=config.device())
-
-imgType = dict(bitDepth=8, channel=0, source=0, load=inTensor.nelement())
-
-opt1 = dict(op='SR', model='a', scale=2)
-opt2 = dict(op='SR', model='lite', scale=2)
-
-def run(cases, times=1):
-    for _, node, _1 in cases:
-        node.learn = times
-        ops[node.op] = newOp(slideAverage(1 - 1 / times))
-    for i in range(times):
-        for process, node, _ in cases:
-            initialETA(node)
-            process(inTensor)
-            torch.cuda.empty_cache()
-
-def show(cases):
-    for _, node, opt in cases:
-        v = opt.copy()
-        if 'opt' in v:
-            del v['opt']
-        print(v, ops[node.op].weight)
-
-
-# In[2]:
-
-
-p1, nodes1 = genProcess([opt1], True, imgType)
-p2, nodes2 = genProcess([opt2], True, imgType)
-cases = [(p1, nodes1[0], opt1), (p2, nodes2[0], opt2)]
-run(cases) # warming up
-
-
-# In[3]:
-
-
-run(cases, 10)
-show(cases)
\ No newline at end of file
+from config import config, process
+
+columns = ('name', 'width', 'height', 'frames', 'seconds', 'secondsPerMP', 'peakMemory', 'tiles', 'weights', 'error')
+
+def listCases():
+  """(name, step, checkpoint path, is video model) of all models."""
+  import runSR, runDN, dehaze, IFRNet, videoSR, ESTRNN
+  for key, item in runSR.mode_switch.items():
+    model = key.rstrip('0123456789')
+    yield 'SR/' + key, dict(op='SR', model=model, scale=int(key[len(model):])), item[0], False
+  for key, item in runDN.mode_switch.items():
+    yield 'DN/' + key, dict(op='DN', model=key), item[0], False
+  for key, item in dehaze.mode_switch.items():
+    yield 'dehaze/' + key, dict(op='dehaze', model=key), item[0], False
+  for key, path in IFRNet.modelPaths.items():
+    yield 'slomo/IFRNet_' + key, dict(op='slomo', model='IFRNet_' + key, sf=2), path, True
+  yield 'VSR/IconVSR', dict(op='VSR'), videoSR.modelPath, True
+  for key, path in ESTRNN.modelPaths.items():
+    yield 'demob/ESTRNN_' + key, dict(op='demob', model=key), path, True
+
+class PeakMemory():
+  """Peak memory used within the block, allocated by torch on GPU, resident size of this process sampled on CPU."""
+  def __init__(self, interval=.005):
+    self.interval = interval
+    self.peak = 0
+
+  def __enter__(self):
+    if config.cuda:
+      torch.cuda.synchronize()
+      self.base = torch.cuda.memory_allocated()
+      torch.cuda.reset_peak_memory_stats()
+    else:
+      self.base = self.peak = process.memory_info().rss
+      self.stopped = threading.Event()
+      def sample():
+        while not self.stopped.wait(self.interval):
+          self.peak = max(self.peak, process.memory_info().rss)
+      self.thread = threading.Thread(target=sample, daemon=True)
+      self.thread.start()
+    return self
+
+  def __exit__(self, *_):
+    if config.cuda:
+      torch.cuda.synchronize()
+      self.peak = torch.cuda.max_memory_allocated()
+    else:
+      self.stopped.set()
+      self.thread.join()
+    self.peak = max(0, self.peak - self.base)
+
+def randomFrames(width, height, count, seed=0):
+  """Frames in the raw bgr48 format the video pipeline reads."""
+  rng = np.random.default_rng(seed)
+  return [rng.integers(0, 1 << 16, (height, width, 3), dtype=np.uint16).tobytes() for _ in range(count)]
+
+def runFrames(step, frames, width, height):
+  """Process the frames by the step like a video, returns (seconds, tiles cropped)."""
+  from progress import counters
+  from video import prepare, padEnd
+  torch.manual_seed(0)
+  steps = [dict(op='decode', width=width, height=height), dict(op='range'), deepcopy(step), dict(op='encode')]
+  _, run, _, stop, refs, *_ = prepare('benchmark', 'cmd', steps)
+  tiles = counters['tiles']
+  start = time.perf_counter()
+  for frame in frames:
+    run((frame, height, width))
+  padEnd(steps, refs, stop, len(frames))
+  run((None, height, width))
+  if config.cuda:
+    torch.cuda.synchronize()
+  return time.perf_counter() - start, counters['tiles'] - tiles
+
+def measure(step, isVideo, width, height, repeat, frameCount):
+  """Median seconds and tiles per frame, peak memory of a run."""
+  frames = randomFrames(width, height, frameCount if isVideo else 1)
+  runFrames(step, frames, width, height) # warm up, models are loaded and cached
+  times, tiles, peak = [], 0, 0
+  for _ in range(repeat):
+    with PeakMemory() as memory:
+      seconds, n = runFrames(step, frames, width, height)
+    times.append(seconds / len(frames))
+    tiles = n / len(frames)
+    peak = max(peak, memory.peak)
+  times.sort()
+  return times[len(times) >> 1], tiles, peak
+
+def benchmark(cases, resolutions, repeat=3, frames=8, onRecord=None):
+  import imageProcess
+  from imageProcess import clean
+  imageProcess.randomWeights = True
+  records = []
+  for name, step, path, isVideo in cases:
+    for width, height in resolutions:
+      record = dict(name=name, width=width, height=height, frames=frames if isVideo else 1,
+        weights='checkpoint' if os.path.exists(path) else 'random', error='')
+      try:
+        seconds, tiles, peak = measure(step, isVideo, width, height, repeat, frames)
+        record.update(seconds=seconds, secondsPerMP=seconds * 1e6 / (width * height), peakMemory=peak, tiles=tiles)
+      except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+      finally:
+        clean()
+      records.append(record)
+      onRecord and onRecord(record)
+    imageProcess.modelCache.clear()
+    imageProcess.weightCache.clear()
+  return records
+
+def environment():
+  try:
+    commit = sp.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=sp.PIPE, stderr=sp.DEVNULL, encoding='utf-8').stdout.strip()
+  except OSError:
+    commit = ''
+  return dict(commit=commit, time=time.time(), platform=platform.platform(), python=platform.python_version(),
+    torch=torch.__version__, device=str(config.device()), dtype=str(config.dtype()), threads=torch.get_num_threads())
+
+def save(prefix, env, records):
+  os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+  with open(prefix + '.json', 'w', encoding='utf-8') as fp:
+    json.dump(dict(environment=env, results=records), fp, ensure_ascii=False, indent=1)
+  with open(prefix + '.csv', 'w', encoding='utf-8', newline='') as fp:
+    writer = csv.DictWriter(fp, columns, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(records)
+
+def parseResolutions(s):
+  return [tuple(int(v) for v in item.split('x')) for item in s.split(',') if item]
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='MoePhoto model benchmark')
+  parser.add_argument('-r', '--resolutions', default='256x256,512x512,1024x1024', type=parseResolutions,
+    help='comma separated WIDTHxHEIGHT of inputs')
+  parser.add_argument('-m', '--models', nargs='*', default=['*'], help='glob patterns of case names like SR/a2 or slomo/*')
+  parser.add_argument('-n', '--repeat', type=int, default=3, help='timed runs per case, the median is reported')
+  parser.add_argument('-f', '--frames', type=int, default=8, help='frames per run of video models')
+  parser.add_argument('-o', '--output', default='.user/benchmark', help='path prefix of the JSON and CSV results')
+  parser.add_argument('--cpu', action='store_true', help='run on CPU even if a GPU is available')
+  parser.add_argument('--list', action='store_true', help='list case names and exit')
+  args = parser.parse_args(argv)
+  if args.cpu:
+    config.cuda = False
+  from headless import setup
+  setup(onNote=lambda _: None)
+  cases = [case for case in listCases() if any(fnmatch.fnmatch(case[0], pattern) for pattern in args.models)]
+  if args.list:
+    print('\n'.join(case[0] for case in cases))
+    return 0
+  env = environment()
+  print('commit {commit}, {device} {dtype}, torch {torch}'.format(**env))
+  print('\t'.join(columns))
+  def show(record):
+    print('\t'.join('{:.6g}'.format(v) if type(v) is float else str(v) for v in (record.get(k, '') for k in columns)), flush=True)
+  records = benchmark(cases, args.resolutions, args.repeat, args.frames, show)
+  save(args.output, env, records)
+  print('results written to {}.json and {}.csv'.format(args.output, args.output))
+  return 1 if any(record['error'] for record in records) else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+Idle CPU usage and round trip latency of the server side pipe waiting,
+busy-wait (poll + idle, the former approach) against blocking fd waits (ipc.receive).
+Run from the repository root: python test/ipcBench.py [idle seconds] [round trips]
+"""
+import sys
+import time
+import multiprocessing as mp
+sys.path.append('./python')
+from gevent import idle
+from ipc import receive
+
+def busyReceive(conn):
+  while not conn.poll():
+    idle()
+  return conn.recv()
+
+def echo(conn, out, delay):
+  while True:
+    task = conn.recv()
+    if task is None:
+      break
+    time.sleep(delay)
+    out.send(task)
+
+def measure(recv, delay, n):
+  taskReceiver, taskSender = mp.Pipe(False)
+  outReceiver, outSender = mp.Pipe(False)
+  p = mp.Process(target=echo, args=(taskReceiver, outSender, delay), daemon=True)
+  p.start()
+  cpu = time.process_time()
+  wall = time.perf_counter()
+  latencies = []
+  for i in range(n):
+    start = time.perf_counter()
+    taskSender.send(i)
+    recv(outReceiver)
+    latencies.append(time.perf_counter() - start - delay)
+  cpu = time.process_time() - cpu
+  wall = time.perf_counter() - wall
+  taskSender.send(None)
+  p.join()
+  latencies.sort()
+  return cpu / wall, latencies[len(latencies) // 2], latencies[-1]
+
+if __name__ == '__main__':
+  mp.set_start_method('spawn')
+  idleSeconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2.
+  n = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+  print('method\tcase\tcpu/wall\tlatency p50 (us)\tlatency max (us)')
+  for name, recv in (('busy-wait', busyReceive), ('blocking', receive)):
+    for case, delay, count in (('idle', idleSeconds, 1), ('round trip', 0, n)):
+      usage, p50, pMax = measure(recv, delay, count)
+      print('{}\t{}\t{:.3f}\t{:.1f}\t{:.1f}'.format(name, case, usage, p50 * 1e6, pMax * 1e6))
@@ -0,0 +1,92 @@
+"""
+Frames per second of the whole video pipeline, with the time spent reading from the decoder, converting frames,
+running models, writing to the encoder pipe and waiting the encoder to finish, so slowdowns of the I/O path show up
+apart from those of models. The source is an ffmpeg lavfi test source like testsrc2 or mandelbrot, or a video file.
+Run from the repository root: python test/videoBenchmark.py [-i testsrc2] [-s 1280x720] [-n 120] [--steps JSON]
+"""
+# pylint: disable=E1101
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from copy import deepcopy
+import torch
+sys.path.append('./python')
+from config import config
+
+stages = ('decode', 'conversion', 'inference', 'preview', 'pipeWait', 'encode', 'other')
+defaultSteps = '[{"op": "SR", "model": "lite", "scale": 2}]'
+
+def sourceArgs(source, width, height, rate):
+  """(video, by, decode step) of SR_vid for the source, test sources are generated by lavfi in the given size and rate."""
+  if os.path.exists(source):
+    decode = dict(codec='-vf scale={}:{}'.format(width, height), width=width, height=height) if width else {}
+    return source, 'url', decode # as url, the input is kept
+  return '{}=size={}x{}:rate={}'.format(source, width or 1280, height or 720, rate), 'cmd', {}
+
+def run(source, steps, frames, outDir, width=0, height=0, rate=24, sync=True):
+  """Process `frames` frames of the source, returns the frame count, wall seconds and seconds of each stage."""
+  from progress import startTiming, stopTiming
+  from video import SR_vid
+  video, by, decode = sourceArgs(source, width, height, rate)
+  videoSteps = [decode, dict(op='range', stop=frames)] + deepcopy(steps) + [dict(op='encode', file=os.path.join(outDir, 'out.mkv'))]
+  startTiming(torch.cuda.synchronize if sync and config.cuda else lambda: None)
+  start = time.perf_counter()
+  try:
+    _, count = SR_vid(video, by, *videoSteps)
+  finally:
+    wall = time.perf_counter() - start
+    times = stopTiming()
+  times['inference'] = times.get('process', 0) - times.get('conversion', 0) - times.get('preview', 0)
+  times['other'] = wall - sum(times.get(k, 0) for k in stages if k != 'other')
+  return count, wall, {k: times.get(k, 0) for k in stages}
+
+def report(count, wall, times):
+  print('{} frames in {:.3f}s, {:.2f} fps'.format(count, wall, count / wall if wall else 0))
+  print('stage\tseconds\tms/frame\tshare')
+  for k in stages:
+    print('{}\t{:.3f}\t{:.2f}\t{:.1%}'.format(k, times[k], times[k] * 1e3 / max(count, 1), times[k] / wall if wall else 0))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='MoePhoto video pipeline benchmark')
+  parser.add_argument('-i', '--input', default='testsrc2', help='lavfi source name like testsrc2 or mandelbrot, or a video path like test/realshort.mp4')
+  parser.add_argument('-s', '--size', default='', help='WIDTHxHEIGHT of frames, default 1280x720 for test sources and the original size for files')
+  parser.add_argument('-r', '--rate', type=float, default=24, help='frame rate of test sources')
+  parser.add_argument('-n', '--frames', type=int, default=120, help='frames to process')
+  parser.add_argument('--steps', default=defaultSteps, help='steps JSON or path of a JSON file, between decode and encode')
+  parser.add_argument('--warmup', type=int, default=8, help='frames to process before timing, 0 to skip')
+  parser.add_argument('--no-sync', dest='sync', action='store_false', help='do not wait GPU work to finish when timing stages')
+  parser.add_argument('--cpu', action='store_true', help='run on CPU even if a GPU is available')
+  parser.add_argument('-o', '--output', help='path to write the JSON report')
+  args = parser.parse_args(argv)
+  if args.cpu:
+    config.cuda = False
+  if os.path.exists(args.steps):
+    with open(args.steps, 'r', encoding='utf-8') as fp:
+      steps = json.load(fp)
+  else:
+    steps = json.loads(args.steps)
+  width, height = (int(v) for v in args.size.split('x')) if args.size else (0, 0)
+  from headless import setup
+  import imageProcess
+  setup(onNote=lambda _: None)
+  imageProcess.randomWeights = True
+  outDir = tempfile.mkdtemp(prefix='moeBench')
+  try:
+    if args.warmup:
+      run(args.input, steps, args.warmup, outDir, width, height, args.rate, args.sync)
+    count, wall, times = run(args.input, steps, args.frames, outDir, width, height, args.rate, args.sync)
+  finally:
+    shutil.rmtree(outDir, ignore_errors=True)
+  report(count, wall, times)
+  if args.output:
+    with open(args.output, 'w', encoding='utf-8') as fp:
+      json.dump(dict(input=args.input, size=args.size, frames=count, steps=steps, device=str(config.device()),
+        seconds=wall, fps=count / wall if wall else 0, stages=times), fp, ensure_ascii=False, indent=1)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())